@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pipeline_state import open_ledger, migrate_checksums, pending, video_ids_with_status
+from instrumentation import latest_summary, PROFILE_ENV, PROFILES
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+fingerprint_file = 'data/cache/pipeline_fingerprints.json'
+
+# The pipeline as a dependency graph. A stage runs once its dependencies have
+# finished, and is skipped when the fingerprint of its inputs matches the one
+# from its last successful run and the ledger has no work left for it.
+# `items` names the ledger stage whose progress counts as items processed;
+# otherwise changed files in `outputs` are counted. With --offline, stages
+# with `offline_args` replay their cached API responses and stages that
+# need the `network` are left out. `opt_in` stages only run when named in
+# --stages.
+STAGES = {
+    '01': {'script': '01-data_acquisition.py', 'deps': [], 'inputs': [], 'outputs': ['data/raw'],
+           'items': 'fetch', 'offline_args': ['--offline']},
+    '02': {'script': '02-data_processing.py', 'deps': ['01'], 'inputs': ['data/raw'],
+           'outputs': ['data/processed'], 'items': 'process'},
+    '03': {'script': '03-data_get_transcripts.py', 'deps': ['02'], 'inputs': ['data/processed'],
+           'outputs': ['data/transcripts', 'data/corpus'], 'items': 'transcript', 'pending': 'transcript',
+           'network': True},
+    '04': {'script': '04-data_get_spotify_features.py', 'deps': ['02'], 'inputs': ['data/processed'],
+           'outputs': ['data/spotify_features'], 'items': 'spotify', 'pending': 'spotify',
+           'offline_args': ['--offline']},
+    '05': {'script': '05-feature_extraction.py', 'deps': ['03'], 'inputs': ['data/corpus'],
+           'outputs': ['data/features']},
+    '06': {'script': '06-model.py', 'deps': ['05'], 'inputs': ['data/features', 'data/processed'],
+           'outputs': ['models']},
+    '07': {'script': '07-export_audio_features.py', 'deps': ['02', '04'],
+           'inputs': ['data/spotify_features', 'data/processed'], 'outputs': ['data/exports']},
+    # Needs torch and transformers, and downloads the model from the Hugging Face Hub on first use
+    '08': {'script': '08-transcript_embeddings.py', 'deps': ['03'], 'inputs': ['data/corpus'],
+           'outputs': ['data/embeddings'], 'network': True, 'opt_in': True},
+    '09': {'script': 'inverted_index.py', 'deps': ['03'], 'inputs': ['data/corpus'], 'outputs': ['data/index']},
+}
+
+
+# Function to list the files under a set of paths, with their size and modification time
+def scan_files(paths):
+    files = {}
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+        for root, _, names in os.walk(path):
+            for name in names:
+                file_path = os.path.join(root, name)
+                stat = os.stat(file_path)
+                files[file_path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+# Function to hash a file's contents, reusing the hash while its size and mtime are unchanged
+def file_digest(file_path, size, mtime_ns, digest_cache):
+    cached = digest_cache.get(file_path)
+    if cached and cached[0] == size and cached[1] == mtime_ns:
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    digest_cache[file_path] = [size, mtime_ns, digest]
+    return digest
+
+# Function to fingerprint the contents of a stage's inputs
+def fingerprint(paths, digest_cache):
+    sha = hashlib.sha256()
+    for file_path, (size, mtime_ns) in sorted(scan_files(paths).items()):
+        sha.update(file_path.encode())
+        sha.update(file_digest(file_path, size, mtime_ns, digest_cache).encode())
+    return sha.hexdigest()
+
+def load_fingerprints():
+    if os.path.exists(fingerprint_file):
+        with open(fingerprint_file, 'r') as f:
+            return json.load(f)
+    return {'stages': {}, 'files': {}}
+
+def save_fingerprints(fingerprints):
+    os.makedirs(os.path.dirname(fingerprint_file), exist_ok=True)
+    tmp_file = f"{fingerprint_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(fingerprints, f)
+    os.replace(tmp_file, fingerprint_file)
+
+
+# Function to count what a stage has done so far, from the ledger or its output files
+def count_items(stage):
+    if stage.get('items'):
+        ledger = open_ledger()
+        try:
+            return len(video_ids_with_status(ledger, stage['items']))
+        finally:
+            ledger.close()
+    return scan_files(stage['outputs'])
+
+def items_processed(before, after):
+    if isinstance(before, int):
+        return after - before
+    return sum(1 for path, stat in after.items() if before.get(path) != stat)
+
+def has_pending_work(stage):
+    if not stage.get('pending'):
+        return False
+    ledger = open_ledger()
+    try:
+        return bool(pending(ledger, stage['pending']))
+    finally:
+        ledger.close()
+
+
+def run_stage(name, stage, args=()):
+    """Run one stage script with `args`, prefixing its output with the stage name"""
+    before = count_items(stage)
+    previous_run = latest_summary(name)
+    start_time = time.perf_counter()
+    command = [sys.executable, '-u', os.path.join(src_dir, stage['script']), *args]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout:
+        print(f"[{name}] {line}", end='', flush=True)
+    returncode = process.wait()
+    elapsed = time.perf_counter() - start_time
+    items = items_processed(before, count_items(stage))
+    # The stage's own run log has its CPU time and peak memory
+    summary = latest_summary(name)
+    if summary == previous_run:
+        summary = None
+    return {'status': 'ok' if returncode == 0 else f"failed ({returncode})", 'seconds': elapsed, 'items': items,
+            'cpu': summary['cpu_seconds'] if summary else None, 'peak_mb': summary['peak_rss_mb'] if summary else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages as a dependency graph.")
+    parser.add_argument('--stages', nargs='+', choices=sorted(STAGES),
+                        default=sorted(name for name, stage in STAGES.items() if not stage.get('opt_in')),
+                        help="stages to consider (default: all but the opt-in embedding stage 08)")
+    parser.add_argument('--force', action='store_true', help="run stages even when their inputs are unchanged")
+    parser.add_argument('--offline', action='store_true', help="replay cached API responses in 01 and 04, and skip 03 and 08, which need the network")
+    parser.add_argument('--workers', type=int, default=2, help="stages to run at the same time")
+    parser.add_argument('--profile', choices=PROFILES,
+                        help="profile every stage with cProfile (cpu) or tracemalloc (memory); see data/logs")
+    args = parser.parse_args()
+    if args.profile:
+        # Picked up by instrumentation.start_run in each stage process
+        os.environ[PROFILE_ENV] = args.profile
+
+    # Import the old checksum file up front so item counts start from the migrated state
+    ledger = open_ledger()
+    migrate_checksums(ledger)
+    ledger.close()
+
+    fingerprints = load_fingerprints()
+    selected = set(args.stages)
+    if args.offline:
+        selected -= {name for name, stage in STAGES.items() if stage.get('network')}
+    results = {}
+    running = {}
+    start_time = time.perf_counter()
+
+    def ready(name):
+        # Dependencies outside the selection count as already satisfied
+        return all(dep not in selected or results.get(dep, {}).get('status') in ('ok', 'skipped')
+                   for dep in STAGES[name]['deps'])
+
+    def blocked(name):
+        return any(dep in selected and dep in results and results[dep]['status'] not in ('ok', 'skipped')
+                   for dep in STAGES[name]['deps'])
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while len(results) < len(selected):
+            for name in sorted(selected - set(results) - set(running)):
+                stage = STAGES[name]
+                if blocked(name):
+                    results[name] = {'status': 'blocked', 'seconds': 0.0, 'items': 0}
+                    continue
+                if not ready(name):
+                    continue
+                input_fingerprint = fingerprint(stage['inputs'], fingerprints['files']) if stage['inputs'] else None
+                up_to_date = (input_fingerprint is not None
+                              and fingerprints['stages'].get(name) == input_fingerprint
+                              and not has_pending_work(stage))
+                if up_to_date and not args.force:
+                    print(f"[{name}] inputs unchanged, skipping.")
+                    results[name] = {'status': 'skipped', 'seconds': 0.0, 'items': 0}
+                    continue
+                stage_args = stage.get('offline_args', []) if args.offline else []
+                future = pool.submit(run_stage, name, stage, stage_args)
+                running[name] = (future, input_fingerprint)
+            if not running:
+                continue
+
+            done, _ = wait([future for future, _ in running.values()], return_when=FIRST_COMPLETED)
+            for name, (future, input_fingerprint) in list(running.items()):
+                if future not in done:
+                    continue
+                del running[name]
+                results[name] = future.result()
+                if results[name]['status'] == 'ok' and input_fingerprint is not None:
+                    fingerprints['stages'][name] = input_fingerprint
+                    save_fingerprints(fingerprints)
+
+    save_fingerprints(fingerprints)
+    print(f"\n{'stage':<34} {'status':<12} {'seconds':>8} {'cpu s':>7} {'peak MB':>8} {'items':>7} {'items/s':>8}")
+    for name in sorted(results):
+        result = results[name]
+        rate = result['items'] / result['seconds'] if result['seconds'] else 0.0
+        cpu = f"{result['cpu']:.1f}" if result.get('cpu') is not None else '-'
+        peak = f"{result['peak_mb']:.0f}" if result.get('peak_mb') is not None else '-'
+        print(f"{STAGES[name]['script']:<34} {result['status']:<12} {result['seconds']:>8.1f} {cpu:>7} {peak:>8} "
+              f"{result['items']:>7} {rate:>8.1f}")
+    print("Per-stage spans and counters are in data/logs; compare runs with "
+          "python src/instrumentation.py compare <stage>.")
+    print(f"Total wall time {time.perf_counter() - start_time:.1f}s")
+    if any(result['status'] not in ('ok', 'skipped') for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
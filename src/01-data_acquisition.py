@@ -1,12 +1,13 @@
 import os
 import json
 import datetime
-import pickle
-import time
+import argparse
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
-import hashlib
+from pipeline_state import open_ledger, migrate_checksums, is_known_video, mark
+from youtube_quota import QuotaScheduler, QuotaExhausted, DAILY_QUOTA
+from http_cache import ResponseCache, CachedHttp, OfflineCacheMiss
+from instrumentation import start_run, span, count, progress_bar
 
 load_dotenv()
 
@@ -17,100 +18,205 @@ API_KEY = os.environ.get("YOUTUBE_DATA_API_KEY")
 API_SERVICE_NAME = 'youtube'
 API_VERSION = 'v3'
 
-def get_authenticated_service():
-    return build(API_SERVICE_NAME, API_VERSION, developerKey=API_KEY)
+# Append-only record of crawled pages, used to resume an interrupted crawl
+CHECKPOINT_FILE = 'data/cache/crawl_checkpoint.ndjson'
 
-# Function to compute the checksum for a video ID
-def compute_checksum(video_id):
-    return hashlib.sha256(video_id.encode()).hexdigest()
+# Partial-response masks: only the attributes later stages read are transferred.
+# 02 reads the title and description, and the export stage the publish date.
+PLAYLIST_ITEM_FIELDS = 'nextPageToken,items/snippet/resourceId/videoId'
+VIDEO_PARTS = 'id,snippet'
+VIDEO_FIELDS = 'items(id,snippet(publishedAt,title,description))'
 
-# Function to check if the video is new based on checksum
-def is_video_new(video_id, checksum_record):
-    checksum = compute_checksum(video_id)
-    return checksum not in checksum_record
-
-
-def get_video_data(youtube, playlist_id):
-    page_token = None
-    all_video_data = []
-    cache_file = 'data/cache/cache.pkl'
+def get_authenticated_service(cache=None):
+    # Route API calls through the response cache when one is given
+    http = CachedHttp(cache) if cache is not None else None
+    return build(API_SERVICE_NAME, API_VERSION, developerKey=API_KEY, http=http)
 
+# Function to load the append-only crawl checkpoint, one record per fetched page
+def load_checkpoint(checkpoint_file):
+    records = []
     try:
-        with open(cache_file, 'rb') as f:
-            all_video_data = pickle.load(f)
+        with open(checkpoint_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves a torn last line; ignore it
+                    break
     except FileNotFoundError:
         pass
-
+    return records
+
+# Function to append a single page record to the checkpoint
+def append_checkpoint(record, checkpoint_file):
+    with span('io.checkpoint'), open(checkpoint_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+# Function to stream video items to an NDJSON file, returning the new file size
+def append_ndjson(items, filename):
+    with span('io.write_raw'), open(filename, 'a') as f:
+        start = f.tell()
+        for item in items:
+            f.write(json.dumps(item, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        count('bytes.written', f.tell() - start)
+        return f.tell()
+
+
+def get_video_data(youtube, playlist_id, ledger, output_file, scheduler,
+                   checkpoint_file=CHECKPOINT_FILE, incremental=True):
+    """Crawl the uploads playlist and stream new videos to output_file as NDJSON.
+
+    The uploads playlist is ordered newest first, so in incremental mode paging
+    stops at the first video the ledger already knows. Every page is
+    checkpointed with its page token, so a killed run resumes where it stopped.
+    Page tokens are offsets, so uploads made since the crawl started shift
+    videos it already fetched onto later pages; those are skipped rather than
+    taken for the first known video, which must predate the crawl.
+    API calls go through `scheduler`; when the daily quota runs out the crawl
+    stops and the checkpoint is left for the next run.
+    Returns the output file actually used, the IDs of the videos written and
+    whether the crawl completed.
+    """
+    page_token = None
+    output_size = 0
+    new_video_ids = []
+
+    # Resume from the checkpoint left behind by an interrupted run
+    records = load_checkpoint(checkpoint_file)
+    if records:
+        output_file = records[0]['output_file']
+        for record in records:
+            new_video_ids.extend(record['video_ids'])
+        page_token = records[-1]['next_page_token']
+        output_size = records[-1]['output_size']
+        print(f"Resuming crawl after {len(records)} checkpointed pages ({len(new_video_ids)} videos).")
+        if records[-1]['done']:
+            return output_file, new_video_ids, True
+    # Videos fetched by this crawl so far; main marks them fetched after every run, resumed or not
+    crawled_ids = set(new_video_ids)
+
+    # Drop anything written after the last checkpoint so resumed pages are not duplicated
+    if os.path.exists(output_file):
+        with open(output_file, 'r+') as f:
+            f.truncate(output_size)
+
+    progress = progress_bar('new videos')
     while True:
         try:
             request = youtube.playlistItems().list(
                 part="snippet",
                 playlistId=playlist_id,
                 maxResults=50,  # max allowed value
-                pageToken=page_token
+                pageToken=page_token,
+                fields=PLAYLIST_ITEM_FIELDS
             )
-            response = request.execute()
-            video_ids = [item['snippet']['resourceId']['videoId'] for item in response['items']]
-            videos_request = youtube.videos().list(
-                part="id,statistics,contentDetails,snippet",
-                id=','.join(video_ids)
-            )
-            videos_response = videos_request.execute()
-            all_video_data.extend(videos_response['items'])
-
-            with open(cache_file, 'wb') as f:
-                pickle.dump(all_video_data, f)
-
-            page_token = response.get('nextPageToken')
-            if not page_token:
-                break
-
-        except HttpError as e:
-            print(f"HTTP error {e.resp.status}: {e.error_details}")
-            if e.resp.status == 403:
-                print("Rate limit exceeded. Sleeping for 100 seconds.")
-                time.sleep(100)
-            else:
-                raise
-
-    return all_video_data
+            response = scheduler.execute('playlistItems.list', request)
+            page_ids = [item['snippet']['resourceId']['videoId'] for item in response.get('items', [])]
+
+            # Keep only new videos; in incremental mode stop at the first known one
+            video_ids = []
+            reached_known = False
+            for video_id in page_ids:
+                if video_id in crawled_ids:
+                    continue
+                if is_known_video(ledger, video_id):
+                    if incremental:
+                        reached_known = True
+                        break
+                    continue
+                video_ids.append(video_id)
+
+            if video_ids:
+                videos_request = youtube.videos().list(
+                    part=VIDEO_PARTS,
+                    id=','.join(video_ids),
+                    fields=VIDEO_FIELDS
+                )
+                videos_response = scheduler.execute('videos.list', videos_request)
+                output_size = append_ndjson(videos_response.get('items', []), output_file)
+                video_ids = [video['id'] for video in videos_response.get('items', [])]
+                new_video_ids.extend(video_ids)
+                crawled_ids.update(video_ids)
+            count('items.pages')
+            progress.update(len(video_ids))
+        except QuotaExhausted as e:
+            # The page in flight is not checkpointed, so the next run fetches it again
+            print(f"Daily YouTube quota exhausted ({e}). Stopping; the next run resumes from the checkpoint.")
+            return output_file, new_video_ids, False
+        except OfflineCacheMiss as e:
+            print(f"{e}. Stopping the offline replay; the next run resumes from the checkpoint.")
+            return output_file, new_video_ids, False
+
+        next_page_token = response.get('nextPageToken')
+        done = reached_known or not next_page_token
+        append_checkpoint({
+            'page_token': page_token,
+            'next_page_token': next_page_token,
+            'video_ids': video_ids,
+            'output_file': output_file,
+            'output_size': output_size,
+            'done': done
+        }, checkpoint_file)
+
+        page_token = next_page_token
+        if done:
+            break
+
+    return output_file, new_video_ids, True
 
 
 def main():
-    youtube = get_authenticated_service()
+    parser = argparse.ArgumentParser(description="Fetch new videos from The Needle Drop's uploads playlist.")
+    parser.add_argument('--full', action='store_true',
+                        help="page through the whole playlist instead of stopping at the first known video")
+    parser.add_argument('--quota-budget', type=int, default=DAILY_QUOTA,
+                        help="YouTube API units this project may spend per day (default: %(default)s)")
+    parser.add_argument('--no-http-cache', action='store_true', help="always call the API instead of reusing cached responses")
+    parser.add_argument('--offline', action='store_true', help="replay cached API responses only, without network access")
+    args = parser.parse_args()
+    start_run('01')
+
+    cache = None if args.no_http_cache else ResponseCache(offline=args.offline)
+    youtube = get_authenticated_service(cache)
     playlist_id = 'UU' + 'UCt7fwAhXDy3oNFTAzF2o8Pw'[2:]  # The Needle Drop's "Uploads" playlist ID
     start_date = "2010-03-08T00:00:00Z"
     end_date = datetime.datetime.utcnow().isoformat() + 'Z'
 
-    # Load or initialize the checksum record
-    checksum_file = 'data/checksums.txt'
-    try:
-        with open(checksum_file, 'r') as f:
-            existing_checksums = {line.strip() for line in f}
-    except FileNotFoundError:
-        existing_checksums = set()
-
-    try:
-        all_video_data = get_video_data(youtube, playlist_id)
-
-        # Filter for new videos based on checksums
-        new_video_data = [video for video in all_video_data if is_video_new(video['id'], existing_checksums)]
-        
-        # Update the checksums file with new video IDs
-        with open(checksum_file, 'a') as f:
-            for video in new_video_data:
-                f.write(compute_checksum(video['id']) + '\n')
-
-    finally:
-        if os.path.exists('data/cache/cache.pkl'):
-            os.remove('data/cache/cache.pkl')
+    # Open the pipeline ledger, importing the old checksum file on first use
+    ledger = open_ledger()
+    migrate_checksums(ledger)
 
     os.makedirs('data/raw', exist_ok=True)
-    filename = f"data/raw/video_data_{start_date}_to_{end_date}.json"
-
-    # Save only new video data
-    with open(filename, 'w') as f:
-        json.dump(new_video_data, f, indent=4)
+    os.makedirs('data/cache', exist_ok=True)
+    filename = f"data/raw/video_data_{start_date}_to_{end_date}.ndjson"
+
+    # New videos are streamed to the raw file page by page
+    scheduler = QuotaScheduler(ledger, args.quota_budget)
+    filename, new_video_ids, complete = get_video_data(youtube, playlist_id, ledger, filename, scheduler,
+                                                       incremental=not args.full)
+
+    # Record the new videos as fetched
+    mark(ledger, 'fetch', new_video_ids, 'fetched')
+    count('items.processed', len(new_video_ids))
+    print(scheduler.report())
+    if cache is not None:
+        print(cache.report())
+        cache.close()
+    ledger.close()
+
+    # Once the crawl completed the checkpoint is no longer needed
+    if complete:
+        os.remove(CHECKPOINT_FILE)
+        print(f"Fetched {len(new_video_ids)} new videos.")
+    else:
+        print(f"Fetched {len(new_video_ids)} new videos so far; the crawl continues on the next run.")
 
 if __name__ == '__main__':
     main()
@@ -1,100 +1,168 @@
-import json
 import os
-import hashlib
 import re
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from video_records import iter_videos, write_ndjson
+from pipeline_state import open_ledger, migrate_checksums, video_ids_with_status, set_titles, mark
+from instrumentation import start_run, span, count
 
 # Define the directory paths
 raw_data_dir = 'data/raw/'
 processed_data_dir = 'data/processed/'
 
-# Regular expression patterns for score extraction
-adjective_score_pattern = re.compile(
-    r"\b(light|decent|strong)\s(\d+(\.\d+)?/10)\b",
+# Regular expression for score extraction. A single pass finds every "<n>/10"
+# candidate, optionally preceded by an adjective; find_all_scores then applies
+# the boundary rules of the adjective ("strong 8/10") and bare ("8/10") forms.
+score_pattern = re.compile(
+    r"(?:\b(light|decent|strong)\s)?(\d+(?:\.\d+)?/10)",
     re.IGNORECASE
 )
 
-simple_score_pattern = re.compile(
-    r"(?<!\S)(\d+(\.\d+)?/10)(?!\S)"
-)
-
-# Function to compute the checksum for a video ID
-def compute_checksum(video_id):
-    return hashlib.sha256(video_id.encode()).hexdigest()
-
-# Function to check if the video is new based on checksum
-def is_video_new(video_id, checksum_record):
-    checksum = compute_checksum(video_id)
-    return checksum not in checksum_record
-
-# Function to process a single JSON file
-def process_video_file(file_path, checksum_record):
-    # Read the JSON data from the file
-    with open(file_path, 'r') as file:
-        video_data = json.load(file)
-
-    # Apply filtering and score extraction
-    processed_videos = []
-    for video in video_data:
-        video_id = video['id']
+# Function to stream the new album reviews from a raw dump, with their scores
+def iter_processed_videos(file_path, processed_ids):
+    for video in iter_videos(file_path):
         title = video['snippet']['title'].lower()
-        description = video['snippet']['description']
         # Filter for "album review" in the title and check if the video is new
-        if "album review" in title and is_video_new(video_id, checksum_record):
-            # Find all scores in the description
-            scores = find_all_scores(description)
-            # Add scores to the video data
-            video['album_score'] = scores
-            processed_videos.append(video)
-            # Update the checksum record
-            checksum_record.add(compute_checksum(video_id))
-
-    return processed_videos
-
-# Function to save processed data to a file
-def save_processed_data(data, original_file_name):
-    # Create a processed file name based on the original one
+        if "album review" not in title or video['id'] in processed_ids:
+            continue
+        # Find all scores in the description and add them to the video data
+        video['album_score'] = find_all_scores(video['snippet']['description'])
+        processed_ids.add(video['id'])
+        yield video
+
+# Function to name the processed file for a raw dump
+def processed_file_path(original_file_name, output_dir=None):
     base_name = os.path.basename(original_file_name)
-    name, ext = os.path.splitext(base_name)
-    processed_file_name = f"{name}_processed{ext}"
-    processed_file_path = os.path.join(processed_data_dir, processed_file_name)
-
-    # Save the processed data to the file
-    with open(processed_file_path, 'w') as file:
-        json.dump(data, file, indent=2)
-
-    return processed_file_path
+    name, _ = os.path.splitext(base_name)
+    return os.path.join(output_dir or processed_data_dir, f"{name}_processed.ndjson")
+
+# Function to process a single raw dump into a compact NDJSON stream
+def process_video_file(file_path, processed_ids, output_dir=None):
+    """Stream new album reviews from `file_path` into its processed NDJSON file.
+
+    A raw dump grows when 01 resumes an interrupted crawl into it, so the
+    new reviews are added after the ones processed from it on earlier runs.
+    The file is replaced atomically, and only when the dump has new reviews.
+    Returns the output path and the (video ID, title) pairs written.
+    """
+    output_path = processed_file_path(file_path, output_dir)
+    tmp_path = f"{output_path}.tmp"
+    videos = []
+    with open(tmp_path, 'w') as file:
+        for video in iter_processed_videos(file_path, processed_ids):
+            write_ndjson([video], file)
+            videos.append((video['id'], video['snippet']['title']))
+    if not videos:
+        os.remove(tmp_path)
+    elif os.path.exists(output_path):
+        # Earlier reviews first, then the new ones, so the result is the same as one run over the full dump
+        merged_path = f"{output_path}.merged"
+        shutil.copyfile(output_path, merged_path)
+        with open(merged_path, 'ab') as merged, open(tmp_path, 'rb') as new:
+            shutil.copyfileobj(new, merged)
+        os.replace(merged_path, output_path)
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, output_path)
+    return output_path, videos
+
+# Processed IDs and output directory shared with worker processes, set by the pool initializer
+_worker_processed_ids = None
+_worker_output_dir = None
+
+def _init_worker(processed_ids, output_dir):
+    global _worker_processed_ids, _worker_output_dir
+    _worker_processed_ids = processed_ids
+    _worker_output_dir = output_dir
+
+def _process_in_worker(file_path):
+    # Workers see the processed IDs as of the start of the run; duplicates
+    # across files processed in parallel are removed by the parent afterwards
+    return process_video_file(file_path, set(_worker_processed_ids), _worker_output_dir)
+
+# Function to drop already-seen videos from a processed file
+def drop_videos(output_path, video_ids):
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'w') as file:
+        count = write_ndjson((video for video in iter_videos(output_path) if video['id'] not in video_ids), file)
+    if count:
+        os.replace(tmp_path, output_path)
+    else:
+        os.remove(tmp_path)
+        os.remove(output_path)
+
+# Function to process raw dumps across a process pool, returning the titles of the new reviews by video ID
+def process_raw_files(file_paths, processed_ids, workers=None, output_dir=None):
+    file_paths = sorted(file_paths)
+    if workers == 1 or len(file_paths) < 2:
+        results = [process_video_file(file_path, processed_ids, output_dir) for file_path in file_paths]
+        return {video_id: title for _, videos in results for video_id, title in videos}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(processed_ids, output_dir)) as pool:
+        results = list(pool.map(_process_in_worker, file_paths))
+
+    written = {}
+    for output_path, videos in results:
+        # A video in several dumps is kept in the first one, as in a serial run
+        duplicates = {video_id for video_id, _ in videos if video_id in processed_ids}
+        if duplicates:
+            drop_videos(output_path, duplicates)
+        for video_id, title in videos:
+            if video_id not in duplicates:
+                processed_ids.add(video_id)
+                written[video_id] = title
+    return written
 
 # Main processing function
 def main():
-    # Load or initialize the checksum record
-    checksum_file = 'data/checksums.txt'
-    try:
-        with open(checksum_file, 'r') as f:
-            existing_checksums = {line.strip() for line in f}
-    except FileNotFoundError:
-        existing_checksums = set()
+    parser = argparse.ArgumentParser(description="Extract album scores from raw video dumps.")
+    parser.add_argument('--workers', type=int, default=None, help="processes to spread raw dumps over (default: CPU count)")
+    args = parser.parse_args()
+    start_run('02')
+
+    # Open the pipeline ledger, importing the old checksum file on first use
+    ledger = open_ledger()
+    migrate_checksums(ledger)
+    processed_ids = video_ids_with_status(ledger, 'process')
 
     # Ensure the processed data directory exists
     os.makedirs(processed_data_dir, exist_ok=True)
 
     # Process all files in the raw data directory
-    for filename in os.listdir(raw_data_dir):
-        if filename.endswith('.json'):
-            file_path = os.path.join(raw_data_dir, filename)
-            processed_videos = process_video_file(file_path, existing_checksums)
-            save_processed_data(processed_videos, file_path)
-
-    # Save the updated checksum record
-    with open(checksum_file, 'w') as f:
-        for checksum in existing_checksums:
-            f.write(checksum + '\n')
-
-# Function to search for both patterns in the description and return matches
+    file_paths = [os.path.join(raw_data_dir, filename) for filename in os.listdir(raw_data_dir)
+                  if filename.endswith(('.json', '.ndjson'))]
+    count('bytes.read', sum(os.path.getsize(file_path) for file_path in file_paths))
+    # Dumps are parsed in worker processes, so this times the whole pool
+    with span('parse.raw_files'):
+        written = process_raw_files(file_paths, processed_ids, args.workers)
+    count('items.processed', len(written))
+    print(f"Processed {len(file_paths)} raw dumps, {len(written)} new album reviews.")
+
+    # Record the new reviews so later stages pick them up
+    with span('io.ledger'):
+        set_titles(ledger, written)
+        mark(ledger, 'process', written, 'processed')
+    ledger.close()
+
+# Function to search the description for scores in one pass and return matches
 def find_all_scores(description):
-    adjective_scores = adjective_score_pattern.findall(description)
-    simple_scores = simple_score_pattern.findall(description)
-    # Flatten the tuple results and merge
-    return [score[1] for score in adjective_scores] + [score[0] for score in simple_scores]
+    adjective_scores = []
+    simple_scores = []
+    for match in score_pattern.finditer(description):
+        score = match.group(2)
+        start, end = match.span(2)
+        after = description[end:end + 1]
+        # "strong 8/10" must end on a word boundary
+        if match.group(1) and not (after.isalnum() or after == '_'):
+            adjective_scores.append(score)
+        # A bare "8/10" must be delimited by whitespace on both sides
+        if (start == 0 or description[start - 1].isspace()) and (not after or after.isspace()):
+            simple_scores.append(score)
+    # Adjective scores come first, matching the order of the earlier two-pass extraction
+    return adjective_scores + simple_scores
+
 
 if __name__ == '__main__':
     main()
@@ -1,74 +1,142 @@
 import os
 import json
+import time
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound
-
-def load_cache(cache_file):
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return json.load(file)
-    return {}
-
-def save_cache(cache, cache_file):
-    with open(cache_file, 'w') as file:
-        json.dump(cache, file)
-
-def get_transcript(video_id, cache, cache_file):
-    if video_id in cache:
-        print(f"Skipping video ID {video_id} as it's in the cache.")
-        return None
+from youtube_transcript_api._errors import TranscriptsDisabled, NoTranscriptFound, TooManyRequests, YouTubeRequestFailed
+from rate_limit import RateLimiter, retry_with_backoff
+from corpus_store import build_corpus
+from pipeline_state import open_ledger, migrate_checksums, pending, BatchedMarker
+from instrumentation import start_run, current_run, span, count, event, progress_bar
+
+# Errors worth retrying; anything else is reported and the video is skipped
+TRANSIENT_ERRORS = (TooManyRequests, YouTubeRequestFailed, requests.exceptions.RequestException)
+
+def get_transcript(video_id, marker, fetch=YouTubeTranscriptApi.get_transcript,
+                   limiter=None, max_retries=4, stats=None):
+    def attempt():
+        if limiter is not None:
+            limiter.acquire()
+        with span('api.transcript'):
+            return fetch(video_id)
+
+    def on_retry(error, attempt_number, delay):
+        if stats is not None:
+            stats['retries'] += 1
+        event('retry', video_id=video_id, error=type(error).__name__, delay=round(delay, 2))
+
     try:
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
-        print(f"Transcript for video ID {video_id} has been fetched successfully.", flush=True)
-        return transcript
+        return retry_with_backoff(attempt, TRANSIENT_ERRORS, max_retries=max_retries, on_retry=on_retry)
     except (TranscriptsDisabled, NoTranscriptFound):
-        cache[video_id] = True
-        save_cache(cache, cache_file)
-        print(f"Transcript unavailable for video ID {video_id}, updating cache.")
+        marker.add(video_id, 'unavailable')
+        if stats is not None:
+            stats['unavailable'] += 1
     except Exception as e:
-        print(f"An error occurred while fetching the transcript for video {video_id}: {e}")
+        if stats is not None:
+            stats['failed'] += 1
+        event('fetch_failed', video_id=video_id, error=str(e))
     return None
 
 def save_transcript(transcript, video_id, directory):
     try:
         filename = f"{directory}/{video_id}_transcript.json"
-        with open(filename, 'w') as file:
+        with span('io.save_transcript'), open(filename, 'w') as file:
             json.dump(transcript, file)
-        print(f"Transcript for video ID {video_id} has been saved to {filename}.")
+            count('bytes.written', file.tell())
+        return True
     except Exception as e:
-        print(f"An error occurred while saving the transcript for video {video_id}: {e}")
-
-def process_video_ids_from_file(file_path, transcripts_dir, cache, cache_file):
-    with open(file_path, 'r') as file:
-        videos_data = json.load(file)
-    video_ids = [video['id'] for video in videos_data]
-    for video_id in video_ids:
-        transcript_path = f"{transcripts_dir}/{video_id}_transcript.json"
-        if not os.path.exists(transcript_path):
-            transcript = get_transcript(video_id, cache, cache_file)
-            if transcript:
-                save_transcript(transcript, video_id, transcripts_dir)
-        else:
-            print(f"Transcript for video ID {video_id} already exists at {transcript_path}.")
+        event('save_failed', video_id=video_id, error=str(e))
+        return False
+
+
+def fetch_transcripts(video_ids, transcripts_dir, ledger, workers=4, rate=2.0,
+                      max_retries=4, fetch=YouTubeTranscriptApi.get_transcript):
+    """Fetch and save transcripts for `video_ids` with a bounded worker pool.
+
+    All workers share one limiter, so `rate` caps requests per second across
+    the pool (retries included). Results are recorded in the ledger in
+    batches. Returns counters and the elapsed wall time.
+    """
+    limiter = RateLimiter(rate) if rate else None
+    marker = BatchedMarker(ledger, 'transcript')
+    stats = Counter()
+    stats_lock = threading.Lock()
+    progress = progress_bar('transcripts', total=len(video_ids))
+
+    def work(video_id):
+        local_stats = Counter()
+        transcript = get_transcript(video_id, marker, fetch, limiter, max_retries, local_stats)
+        if transcript and save_transcript(transcript, video_id, transcripts_dir):
+            marker.add(video_id, 'fetched')
+            local_stats['fetched'] += 1
+        elif transcript:
+            local_stats['failed'] += 1  # Fetched but could not be saved
+        with stats_lock:
+            stats.update(local_stats)
+        outcome = 'fetched' if local_stats['fetched'] else 'unavailable' if local_stats['unavailable'] else 'failed'
+        progress.update(**{outcome: 1})
+
+    start_time = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Consume results so worker exceptions surface here
+            for _ in pool.map(work, video_ids):
+                pass
+    finally:
+        marker.flush()
+        progress.close()
+    stats['elapsed'] = time.monotonic() - start_time
+    return stats
+
 
 def main():
-    processed_dir = 'data/processed'
+    parser = argparse.ArgumentParser(description="Fetch transcripts for processed album review videos.")
+    parser.add_argument('--workers', type=int, default=4, help="number of concurrent fetches")
+    parser.add_argument('--rps', type=float, default=2.0,
+                        help="maximum transcript requests per second across all workers (0 for no limit)")
+    parser.add_argument('--max-retries', type=int, default=4, help="retries per video for transient errors")
+    parser.add_argument('--transcript-server', default=None,
+                        help="base URL of a fake transcript server (see fake_transcript_server.py) to fetch from instead of YouTube")
+    args = parser.parse_args()
+    start_run('03')
+
     transcripts_dir = 'data/transcripts'
-    cache_dir = 'data/cache'
-    cache_file = f"{cache_dir}/transcript_cache.json"
+    corpus_dir = 'data/corpus'
 
     if not os.path.exists(transcripts_dir):
         os.makedirs(transcripts_dir)
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
 
-    cache = load_cache(cache_file)
+    # Open the pipeline ledger, importing the old checksum file and caches on first use
+    ledger = open_ledger()
+    migrate_checksums(ledger)
+
+    fetch = YouTubeTranscriptApi.get_transcript
+    if args.transcript_server:
+        from fake_transcript_server import make_fetcher
+        fetch = make_fetcher(args.transcript_server)
+
+    # Processed reviews with neither a transcript nor a known miss
+    video_ids = [video_id for video_id, _ in pending(ledger, 'transcript')]
+    print(f"{len(video_ids)} videos need transcripts.")
+
+    stats = fetch_transcripts(video_ids, transcripts_dir, ledger, args.workers, args.rps,
+                              args.max_retries, fetch)
+    ledger.close()
+    rate = len(video_ids) / stats['elapsed'] if stats['elapsed'] else 0.0
+    print(f"Processed {len(video_ids)} videos in {stats['elapsed']:.1f}s ({rate:.2f} videos/s): "
+          f"{stats['fetched']} fetched, {stats['unavailable']} unavailable, "
+          f"{stats['failed']} failed, {stats['retries']} retries.")
+    count('items.processed', stats['fetched'])
+    if stats['failed']:
+        print(f"Errors for the failed videos are in {current_run().path}.")
 
-    for file_name in os.listdir(processed_dir):
-        if file_name.endswith('.json'):
-            file_path = os.path.join(processed_dir, file_name)
-            print(f"Processing file: {file_path}")
-            process_video_ids_from_file(file_path, transcripts_dir, cache, cache_file)
+    # Append the new transcripts to the packed corpus read by later stages
+    appended = build_corpus(transcripts_dir, corpus_dir)
+    print(f"Appended {appended} transcripts to the corpus in {corpus_dir}.")
 
 if __name__ == "__main__":
     main()
@@ -1,114 +1,245 @@
 import os
 import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
-import glob
+from urllib3.util.retry import Retry
 import dotenv
-import time
-import glob
+from rate_limit import RateLimiter
+from http_cache import ResponseCache, CachedSession
+from pipeline_state import open_ledger, migrate_checksums, pending, mark
+from instrumentation import start_run, span, count, event, progress_bar
 
 # Load environment variables
 dotenv.load_dotenv()
 
 # Define paths
-processed_dir = 'data/processed'
 spotify_features_dir = 'data/spotify_features'
+# Search results from earlier runs, so an interrupted run continues where it stopped
+progress_file = 'data/cache/spotify_progress.json'
+
+# Maximum number of IDs Spotify accepts per call on the bulk endpoints
+ALBUMS_PER_REQUEST = 20
+ARTISTS_PER_REQUEST = 50
+AUDIO_FEATURES_PER_REQUEST = 100
+
+
+# Same retry policy spotipy mounts on the sessions it builds itself
+SPOTIFY_RETRY = Retry(total=3, connect=None, read=False, status=3, backoff_factor=0.3,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']))
+
+
+def get_spotify_client(cache=None):
+    if cache is None:
+        return spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=os.environ['SPOTIFY_CLIENT_ID'],
+                                                                   client_secret=os.environ['SPOTIFY_SECRET']))
+    session = CachedSession(cache, max_retries=SPOTIFY_RETRY)
+    if cache.offline:
+        # Replayed responses need no token, so skip the credentials flow
+        return spotipy.Spotify(auth='offline', requests_session=session)
+    return spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=os.environ['SPOTIFY_CLIENT_ID'],
+                                                               client_secret=os.environ['SPOTIFY_SECRET']),
+                           requests_session=session)
+
+# Function to split a list into consecutive batches of at most `size` items
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def load_progress(progress_file):
+    if os.path.exists(progress_file):
+        with open(progress_file, 'r') as file:
+            return json.load(file)
+    return {'matches': {}}
 
-# Ensure the target directory exists
-if not os.path.exists(spotify_features_dir):
-    os.makedirs(spotify_features_dir)
+def save_progress(progress, progress_file):
+    tmp_file = f"{progress_file}.tmp"
+    with open(tmp_file, 'w') as file:
+        json.dump(progress, file)
+    os.replace(tmp_file, progress_file)
 
-# Set up Spotify client
-sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=os.environ['SPOTIFY_CLIENT_ID'],
-                                                           client_secret=os.environ['SPOTIFY_SECRET']))
+def artist_data_from(artist_info):
+    return {
+        'popularity': artist_info['popularity'],
+        'followers': artist_info['followers']['total'],
+        'genres': artist_info['genres'],
+        'images': artist_info['images'],
+        'external_urls': artist_info['external_urls'],
+        'spotify_uri': artist_info['uri'],
+        'spotify_url': artist_info['external_urls']['spotify']
+    }
 
-def get_album_tracks(album_id, artist_id):
-    """Fetch tracks and their audio features of an album by its Spotify ID, and artist information"""
+
+def search_album(sp, title, limiter):
+    """Search Spotify for the album reviewed in a video, given the video title.
+
+    Returns the album and main artist IDs, None when nothing was found, or
+    False when the search failed and should be retried on a later run.
+    """
+    # Modify title to remove " ALBUM REVIEW" or " album review"
+    title = title.replace(" ALBUM REVIEW", "").replace(" album review", "")
+    limiter.acquire()
     try:
-        tracks = []
-        album_tracks = sp.album_tracks(album_id)
-        artist_info = sp.artist(artist_id)
-        artist_data = {
-            'popularity': artist_info['popularity'],
-            'followers': artist_info['followers']['total'],
-            'genres': artist_info['genres'],
-            'images': artist_info['images'],
-            'external_urls': artist_info['external_urls'],
-            'spotify_uri': artist_info['uri'],
-            'spotify_url': artist_info['external_urls']['spotify']
-        }
-        for track in album_tracks['items']:
-            track_info = {
-                'name': track['name'],
-                'id': track['id'],
-                'audio_features': sp.audio_features(track['id'])[0]
-            }
-            tracks.append(track_info)
-        return tracks, artist_data
+        with span('api.search'):
+            result = sp.search(title, type='album')
     except Exception as e:
-        print(f"Error fetching tracks, audio features, or artist information for album {album_id}: {e}")
-        return None, None
+        event('search_failed', title=title, error=str(e))
+        return False
+    if not result['albums']['items']:
+        event('not_found', title=title)
+        return None
+    album = result['albums']['items'][0]
+    # Assuming the first artist is the main artist
+    return {'album_id': album['id'], 'artist_id': album['artists'][0]['id']}
 
 
-def main():
-    start_time = time.time()  # Record the start time
-    max_duration = 3 * 60  # 3 hours in seconds
+def fetch_bulk(call, ids, batch_size, key, pool, limiter, stats):
+    """Fetch objects for `ids` from a bulk endpoint, one batch per request, concurrently.
+
+    Returns a dict from ID to object (None where Spotify has no object for
+    that ID). IDs from batches that failed are left out.
+    """
+    def fetch_batch(batch):
+        limiter.acquire()
+        try:
+            with span(f"api.{key or 'audio_features'}"):
+                response = call(batch)
+        except Exception as e:
+            event('fetch_failed', endpoint=key or 'audio_features', ids=len(batch), error=str(e))
+            return {}
+        objects = response[key] if key else response
+        return dict(zip(batch, objects))
 
-    # Loop through all JSON files in processed_dir
-    for file_name in glob.glob(f'{processed_dir}/*.json'):
-        if time.time() - start_time > max_duration:
-            print("Time limit exceeded. Stopping the process.")
-            break  # Exit the loop if 3 hours have passed
+    batches = list(chunks(ids, batch_size))
+    stats['api_calls'] += len(batches)
+    results = {}
+    for batch_result in pool.map(fetch_batch, batches):
+        results.update(batch_result)
+    return results
 
-        print(f"Processing file: {file_name}")
+
+def process_videos(sp, videos, progress, ledger, artist_cache, pool, limiter, stats, progress_output=None):
+    """Search, enrich and save a batch of (video ID, title) pairs, issuing bulk requests across the whole batch"""
+    matches = progress['matches']
+
+    # Searches cannot be batched, so run them concurrently instead
+    to_search = [(video_id, title) for video_id, title in videos if video_id not in matches]
+    stats['api_calls'] += len(to_search)
+    results = pool.map(lambda video: search_album(sp, video[1], limiter), to_search)
+    not_found = []
+    for (video_id, _), match in zip(to_search, results):
+        if match is None:
+            not_found.append(video_id)
+        elif match is not False:
+            matches[video_id] = match
+    # Searches that found nothing are not repeated on later runs
+    mark(ledger, 'spotify', not_found, 'not_found')
+
+    matched = [(video_id, matches[video_id]) for video_id, _ in videos if matches.get(video_id)]
+    album_ids = list(dict.fromkeys(match['album_id'] for _, match in matched))
+    albums = fetch_bulk(sp.albums, album_ids, ALBUMS_PER_REQUEST, 'albums', pool, limiter, stats)
+
+    # Artists are memoized for the whole run, since most release several albums
+    artist_ids = list(dict.fromkeys(match['artist_id'] for _, match in matched
+                                    if match['artist_id'] not in artist_cache))
+    artists = fetch_bulk(sp.artists, artist_ids, ARTISTS_PER_REQUEST, 'artists', pool, limiter, stats)
+    for artist_id, artist_info in artists.items():
+        if artist_info is not None:
+            artist_cache[artist_id] = artist_data_from(artist_info)
+
+    track_ids = list(dict.fromkeys(track['id'] for album in albums.values() if album
+                                   for track in album['tracks']['items']))
+    audio_features = fetch_bulk(sp.audio_features, track_ids, AUDIO_FEATURES_PER_REQUEST, None,
+                                pool, limiter, stats)
+
+    saved = []
+    for video_id, match in matched:
+        album = albums.get(match['album_id'])
+        artist_data = artist_cache.get(match['artist_id'])
+        if album is None or artist_data is None:
+            event('incomplete', video_id=video_id, album_id=match['album_id'], missing='album or artist')
+            continue  # Retried on the next run
+        album_tracks = album['tracks']['items']
+        if any(track['id'] not in audio_features for track in album_tracks):
+            event('incomplete', video_id=video_id, album_id=match['album_id'], missing='audio features')
+            continue
+        tracks = [{
+            'name': track['name'],
+            'id': track['id'],
+            'audio_features': audio_features[track['id']]
+        } for track in album_tracks]
+        # Save the tracks data along with their audio features and artist information
+        # to spotify_features_dir with the video ID in the filename
+        album_data = {
+            'tracks': tracks,
+            'artist_info': artist_data
+        }
+        output_file = f'{spotify_features_dir}/{video_id}.json'
         try:
-            with open(file_name) as f:
-                videos = json.load(f)
+            with span('io.save_features'), open(output_file, 'w') as outfile:
+                json.dump(album_data, outfile)
+                count('bytes.written', outfile.tell())
+            saved.append(video_id)
         except Exception as e:
-            print(f"Error reading file {file_name}: {e}")
-            continue  # Skip to next file on error
-        
-        for video in videos:
-            # Extract video ID
-            video_id = video['id']
-            print(f"Processing video ID: {video_id}")
-            # Define the output file path
-            output_file = f'{spotify_features_dir}/{video_id}.json'
-            # Check if the Spotify features file already exists
-            if os.path.exists(output_file):
-                print(f"Spotify features file for video ID {video_id} already exists. Skipping.", flush=True)
-                continue  # Skip to next video if file exists
-            # Modify title to remove " ALBUM REVIEW" or " album review"
-            title = video['snippet']['title'].replace(" ALBUM REVIEW", "").replace(" album review", "")
-            # Search Spotify for the album
-            try:
-                result = sp.search(title, type='album')
-            except Exception as e:
-                print(f"Error searching Spotify for {title}: {e}")
-                continue  # Skip to next video on error
-            
-            if result['albums']['items']:
-                album = result['albums']['items'][0]
-                album_id = album['id']
-                artist_id = album['artists'][0]['id']  # Assuming the first artist is the main artist
-                # Get the tracks of the album and artist information
-                tracks, artist_data = get_album_tracks(album_id, artist_id)
-                if tracks is None or artist_data is None:
-                    continue  # Skip to next video on error
-                # Save the tracks data along with their audio features and artist information
-                # to spotify_features_dir with the video ID in the filename
-                album_data = {
-                    'tracks': tracks,
-                    'artist_info': artist_data
-                }
-                try:
-                    with open(output_file, 'w') as outfile:
-                        json.dump(album_data, outfile)
-                    print(f"Saved Spotify data, audio features, and artist information for video ID {video_id} to {output_file}", flush=True)
-                except Exception as e:
-                    print(f"Error saving file {output_file}: {e}")
-            else:
-                print(f"No albums found on Spotify for search term: {title}")
+            event('save_failed', video_id=video_id, error=str(e))
+    mark(ledger, 'spotify', saved, 'matched')
+    stats['saved'] += len(saved)
+    if progress_output is not None:
+        progress_output.update(saved=len(saved), not_found=len(not_found),
+                               retry_later=len(videos) - len(saved) - len(not_found))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch Spotify album, artist and audio features for processed reviews.")
+    parser.add_argument('--max-duration', type=float, default=3 * 60 * 60,
+                        help="time budget in seconds; progress is saved so the next run continues (default: 3 hours)")
+    parser.add_argument('--batch-size', type=int, default=100, help="videos enriched per round of bulk requests")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent Spotify requests")
+    parser.add_argument('--rps', type=float, default=5.0, help="maximum Spotify requests per second")
+    parser.add_argument('--no-http-cache', action='store_true', help="always call the API instead of reusing cached responses")
+    parser.add_argument('--offline', action='store_true', help="replay cached API responses only, without network access")
+    args = parser.parse_args()
+    start_run('04')
+
+    start_time = time.time()  # Record the start time
+
+    # Ensure the target directories exist
+    os.makedirs(spotify_features_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(progress_file), exist_ok=True)
+
+    cache = None if args.no_http_cache else ResponseCache(offline=args.offline)
+    sp = get_spotify_client(cache)
+    progress = load_progress(progress_file)
+    # Open the pipeline ledger, importing the old checksum file on first use
+    ledger = open_ledger()
+    migrate_checksums(ledger)
+    videos_left = pending(ledger, 'spotify')
+    print(f"{len(videos_left)} videos need Spotify features.")
+
+    limiter = RateLimiter(args.rps)
+    artist_cache = {}
+    stats = Counter()
+    progress_output = progress_bar('videos', total=len(videos_left))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for videos in chunks(videos_left, args.batch_size):
+            if time.time() - start_time > args.max_duration:
+                print("Time limit exceeded. Stopping the process; the next run continues from here.")
+                break
+            process_videos(sp, videos, progress, ledger, artist_cache, pool, limiter, stats, progress_output)
+            save_progress(progress, progress_file)
+    progress_output.close()
+    count('items.processed', stats['saved'])
+    ledger.close()
+    if cache is not None:
+        print(cache.report())
+        cache.close()
+
+    print(f"Saved Spotify features for {stats['saved']} videos using {stats['api_calls']} API calls "
+          f"in {time.time() - start_time:.1f}s.")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,180 @@
+import os
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from corpus_store import TranscriptCorpus
+from store_files import load_json, save_json
+from instrumentation import start_run, span, count
+
+# Define the directory paths
+corpus_dir = 'data/corpus'
+features_dir = 'data/features'
+
+MANIFEST_FILE = 'manifest.json'
+# Written by versions that stored one document frequency file outside the manifest
+LEGACY_DOC_FREQ_FILE = 'doc_freq.npy'
+
+# Shards are merged into one once there are more than this many
+MAX_SHARDS = 16
+
+# Hashing keeps the feature space fixed, so new documents never change the
+# columns of earlier ones and the matrix can grow by appending rows
+N_FEATURES = 2 ** 20
+NGRAM_RANGE = (1, 2)
+
+
+def make_vectorizer():
+    """Vectorizer producing raw term counts for unigrams and bigrams"""
+    return HashingVectorizer(n_features=N_FEATURES, ngram_range=NGRAM_RANGE, alternate_sign=False,
+                             norm=None, dtype=np.float32)
+
+def load_manifest(features_dir):
+    return load_json(os.path.join(features_dir, MANIFEST_FILE),
+                     {'n_features': N_FEATURES, 'ngram_range': list(NGRAM_RANGE), 'n_docs': 0, 'shards': []})
+
+def save_manifest(manifest, features_dir):
+    save_json(manifest, os.path.join(features_dir, MANIFEST_FILE))
+
+# Function to name the file a new shard (and its document frequencies) go in
+def next_shard_number(manifest):
+    return manifest.get('next_shard', len(manifest['shards']))
+
+def load_doc_freq(features_dir, manifest=None):
+    """Document frequencies of every featurized document, as recorded in the manifest"""
+    manifest = manifest or load_manifest(features_dir)
+    doc_freq_file = manifest.get('doc_freq')
+    if doc_freq_file is None and manifest['shards']:
+        doc_freq_file = LEGACY_DOC_FREQ_FILE
+    if doc_freq_file is None:
+        return np.zeros(N_FEATURES, dtype=np.int32)
+    return np.load(os.path.join(features_dir, doc_freq_file))
+
+def remove_files(features_dir, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(features_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def update_features(corpus, features_dir=features_dir):
+    """Count terms in transcripts that are not featurized yet and append them as a new shard.
+
+    Only the new documents are tokenized. Their document frequencies are
+    added to the stored ones, so IDF never needs the earlier documents.
+    Every run adds a shard, and once there are more than MAX_SHARDS they are
+    merged into one (see `compact_features`). Returns the number of documents
+    added.
+    """
+    os.makedirs(features_dir, exist_ok=True)
+    manifest = load_manifest(features_dir)
+    if manifest['n_features'] != N_FEATURES or tuple(manifest['ngram_range']) != NGRAM_RANGE:
+        raise ValueError(f"Features in {features_dir} were built with different settings; remove them to rebuild")
+
+    featurized = {video_id for shard in manifest['shards'] for video_id in shard['video_ids']}
+    new_ids = [video_id for video_id in corpus.video_ids if video_id not in featurized]
+    if not new_ids:
+        return 0
+
+    with span('parse.vectorize'):
+        counts = make_vectorizer().transform(corpus.text(video_id) for video_id in new_ids).tocsr()
+        counts.sum_duplicates()
+    doc_freq = load_doc_freq(features_dir, manifest)
+    doc_freq += np.bincount(counts.indices, minlength=N_FEATURES).astype(np.int32)
+
+    # Both files get new names, so until the manifest names them the committed ones are untouched
+    number = next_shard_number(manifest)
+    shard_file = f"counts_{number:05d}.npz"
+    doc_freq_file = f"doc_freq_{number:05d}.npy"
+    with span('io.save_shard'):
+        sp.save_npz(os.path.join(features_dir, shard_file), counts)
+        np.save(os.path.join(features_dir, doc_freq_file), doc_freq)
+    count('bytes.written', os.path.getsize(os.path.join(features_dir, shard_file)) + doc_freq.nbytes)
+
+    # Writing the manifest commits the shard and its document frequencies together
+    previous_doc_freq = manifest.get('doc_freq', LEGACY_DOC_FREQ_FILE)
+    manifest['shards'].append({'file': shard_file, 'video_ids': new_ids})
+    manifest['n_docs'] += len(new_ids)
+    manifest['doc_freq'] = doc_freq_file
+    manifest['next_shard'] = number + 1
+    save_manifest(manifest, features_dir)
+    remove_files(features_dir, [previous_doc_freq])
+
+    if len(manifest['shards']) > MAX_SHARDS:
+        compact_features(features_dir)
+    return len(new_ids)
+
+
+def compact_features(features_dir=features_dir):
+    """Merge every shard into one, so loading reads a single file; returns the number of shards merged"""
+    manifest = load_manifest(features_dir)
+    if len(manifest['shards']) < 2:
+        return 0
+    video_ids, counts = load_counts(features_dir)
+    number = next_shard_number(manifest)
+    shard_file = f"counts_{number:05d}.npz"
+    with span('io.compact_shards'):
+        sp.save_npz(os.path.join(features_dir, shard_file), counts)
+    old_files = [shard['file'] for shard in manifest['shards']]
+    manifest['shards'] = [{'file': shard_file, 'video_ids': video_ids}]
+    manifest['next_shard'] = number + 1
+    save_manifest(manifest, features_dir)
+    remove_files(features_dir, old_files)
+    return len(old_files)
+
+
+def idf_weights(doc_freq, n_docs):
+    """Smoothed IDF, as in scikit-learn's TfidfTransformer"""
+    return (np.log((1 + n_docs) / (1 + doc_freq.astype(np.float64))) + 1).astype(np.float32)
+
+def apply_tfidf(counts, idf, sublinear_tf=True):
+    """Weight a count matrix by IDF and L2-normalize its rows"""
+    tfidf = counts.astype(np.float32, copy=True)
+    if sublinear_tf:
+        np.log1p(tfidf.data, out=tfidf.data)
+    tfidf.data *= idf[tfidf.indices]
+    return normalize(tfidf, norm='l2', copy=False)
+
+def load_counts(features_dir=features_dir):
+    """Video IDs and the stacked term-count matrix of every shard"""
+    manifest = load_manifest(features_dir)
+    video_ids = [video_id for shard in manifest['shards'] for video_id in shard['video_ids']]
+    shards = [sp.load_npz(os.path.join(features_dir, shard['file'])) for shard in manifest['shards']]
+    counts = sp.vstack(shards, format='csr') if shards else sp.csr_matrix((0, N_FEATURES), dtype=np.float32)
+    return video_ids, counts
+
+def load_tfidf(features_dir=features_dir):
+    """Video IDs, the TF-IDF document-term matrix and the IDF weights"""
+    video_ids, counts = load_counts(features_dir)
+    idf = idf_weights(load_doc_freq(features_dir), len(video_ids))
+    return video_ids, apply_tfidf(counts, idf), idf
+
+def transform_texts(texts, idf):
+    """TF-IDF features for new texts, e.g. a user-submitted review, using stored IDF weights"""
+    return apply_tfidf(make_vectorizer().transform(texts), idf)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build TF-IDF features from review transcripts.")
+    parser.add_argument('--features-dir', default=features_dir)
+    args = parser.parse_args()
+    start_run('05')
+
+    start_time = time.perf_counter()
+    with TranscriptCorpus(corpus_dir) as corpus:
+        added = update_features(corpus, args.features_dir)
+    count('items.processed', added)
+    elapsed = time.perf_counter() - start_time
+    print(f"Featurized {added} new transcripts in {elapsed:.2f}s.")
+
+    start_time = time.perf_counter()
+    with span('io.load_tfidf'):
+        video_ids, tfidf, _ = load_tfidf(args.features_dir)
+    elapsed = time.perf_counter() - start_time
+    print(f"Loaded TF-IDF matrix of {len(video_ids)} documents with {tfidf.nnz} non-zeros in {elapsed:.2f}s.")
+
+if __name__ == '__main__':
+    main()
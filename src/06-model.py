@@ -0,0 +1,352 @@
+"""Score prediction from review text.
+
+Run without arguments to train a ridge regression on the TF-IDF features
+from 05-feature_extraction and the album scores extracted by
+02-data_processing, saved to models/predictor_model.pkl.
+
+`ScoringService` loads the model once and answers predictions from Python or
+over HTTP (--serve). Requests arriving together are micro-batched into one
+vectorized prediction, and repeated texts are answered from an LRU cache.
+--benchmark load-tests the HTTP service at several concurrency levels.
+"""
+import os
+import json
+import time
+import queue
+import pickle
+import random
+import hashlib
+import argparse
+import importlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import requests
+from sklearn.linear_model import Ridge
+from video_records import load_scores
+from corpus_store import TranscriptCorpus
+from instrumentation import start_run, span, count
+
+features = importlib.import_module('05-feature_extraction')
+
+# Define the directory paths
+features_dir = 'data/features'
+processed_data_dir = 'data/processed/'
+model_file = 'models/predictor_model.pkl'
+
+def train_model(features_dir=features_dir, processed_dir=processed_data_dir, alpha=1.0, test_size=0.2, seed=42):
+    """Fit a ridge regression of album score on TF-IDF features.
+
+    A held-out split is used to report the mean absolute error; the saved
+    model is then refit on every scored review.
+    """
+    with span('io.load_features'):
+        video_ids, tfidf, idf = features.load_tfidf(features_dir)
+    with span('parse.scores'):
+        scores = load_scores(processed_dir)
+    rows = [i for i, video_id in enumerate(video_ids) if video_id in scores]
+    if len(rows) < 10:
+        raise ValueError(f"Only {len(rows)} featurized reviews have a score; run 02 and 05 first")
+    X = tfidf[rows]
+    y = np.array([scores[video_ids[i]] for i in rows])
+
+    order = np.random.default_rng(seed).permutation(len(rows))
+    n_test = max(1, int(len(rows) * test_size))
+    test, train = order[:n_test], order[n_test:]
+    with span('model.fit'):
+        model = Ridge(alpha=alpha).fit(X[train], y[train])
+    mae = float(np.mean(np.abs(np.clip(model.predict(X[test]), 0, 10) - y[test])))
+    baseline = float(np.mean(np.abs(np.mean(y[train]) - y[test])))
+
+    with span('model.fit'):
+        model = Ridge(alpha=alpha).fit(X, y)
+    count('items.processed', len(rows))
+    return {'model': model, 'vectorizer': features.make_vectorizer(), 'idf': idf,
+            'metrics': {'reviews': len(rows), 'test_mae': mae, 'baseline_mae': baseline},
+            'trained_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+def save_model(bundle, path=model_file):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(bundle, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_model(path=model_file):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+class ScoringService:
+    """Predicts album scores for review texts with a model loaded once.
+
+    `predict` is safe to call from many threads: calls are queued and a
+    single batching thread featurizes up to `max_batch_size` texts at a time,
+    waiting at most `max_wait` seconds for a batch to fill. Predictions are
+    kept in an LRU cache of `cache_size` entries keyed by a hash of the text.
+    """
+
+    def __init__(self, bundle, max_batch_size=64, max_wait=0.002, cache_size=4096):
+        self.vectorizer = bundle['vectorizer']
+        self.idf = bundle['idf']
+        model = bundle['model']
+        # A dense coefficient vector makes a batch prediction one sparse matrix-vector product
+        self.coef = np.asarray(model.coef_, dtype=np.float64).ravel()
+        self.intercept = float(model.intercept_)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.stats = {'requests': 0, 'cache_hits': 0, 'batches': 0, 'batched_texts': 0}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_file(cls, path=model_file, **options):
+        return cls(load_model(path), **options)
+
+    def predict_batch(self, texts):
+        """Scores for a list of texts in one vectorized pass, bypassing the queue and cache"""
+        X = features.apply_tfidf(self.vectorizer.transform(texts), self.idf)
+        return np.clip(X @ self.coef + self.intercept, 0, 10).tolist()
+
+    def submit(self, text):
+        """Queue a text for scoring, returning a Future of its score"""
+        key = hashlib.sha1(text.encode()).digest()
+        future = Future()
+        with self._lock:
+            # Checked under the lock so nothing is queued behind close()'s sentinel
+            if self._closed:
+                raise RuntimeError("ScoringService is closed")
+            self.stats['requests'] += 1
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                future.set_result(self._cache[key])
+                return future
+            self._queue.put((key, text, future))
+        return future
+
+    def predict(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    def predict_many(self, texts, timeout=None):
+        # Queue every text before waiting so they can share batches
+        futures = [self.submit(text) for text in texts]
+        return [future.result(timeout) for future in futures]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._score(batch)
+
+    def _score(self, batch):
+        # The same text queued twice in a batch is featurized once
+        unique = {}
+        for key, text, _ in batch:
+            unique.setdefault(key, text)
+        try:
+            scores = dict(zip(unique, self.predict_batch(list(unique.values()))))
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batched_texts'] += len(unique)
+            for key, score in scores.items():
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for key, _, future in batch:
+            future.set_result(scores[key])
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, ScoringHandler)
+        self.service = service
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections spare clients a TCP handshake per request; with
+    # Nagle's algorithm on, the separate header and body writes stall on delayed ACKs
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'not found'})
+            return
+        self.send_json(200, {'status': 'ok', **self.server.service.stats})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_json(400, {'error': 'invalid JSON'})
+            return
+        if not isinstance(payload, dict):
+            self.send_json(400, {'error': "expected a JSON object with 'text' or 'texts'"})
+        elif isinstance(payload.get('text'), str):
+            self.send_json(200, {'score': self.server.service.predict(payload['text'])})
+        elif isinstance(payload.get('texts'), list) and all(isinstance(text, str) for text in payload['texts']):
+            self.send_json(200, {'scores': self.server.service.predict_many(payload['texts'])})
+        else:
+            self.send_json(400, {'error': "expected 'text' or 'texts'"})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to start the scoring server on a background thread
+def start_server(service, host='127.0.0.1', port=0):
+    server = ScoringServer((host, port), service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# Function to build request texts from the corpus, with a share of repeats to exercise the cache
+def benchmark_texts(n_requests, repeat_ratio, seed=0, corpus_dir='data/corpus'):
+    rng = random.Random(seed)
+    with TranscriptCorpus(corpus_dir) as corpus:
+        video_ids = rng.sample(corpus.video_ids, min(len(corpus.video_ids), 500))
+        pool = [corpus.text(video_id) for video_id in video_ids]
+    texts = []
+    for i in range(n_requests):
+        if texts and rng.random() < repeat_ratio:
+            texts.append(rng.choice(texts))
+        else:
+            # Trim review excerpts of varying length so most texts are distinct
+            text = rng.choice(pool)
+            start = rng.randrange(max(1, len(text) - 200))
+            texts.append(f"{text[start:start + rng.randint(200, 3000)]} {i}")
+    return texts
+
+def run_benchmark(service, concurrency_levels, n_requests, repeat_ratio):
+    server = start_server(service)
+    texts = benchmark_texts(n_requests, repeat_ratio)
+    local = threading.local()
+
+    def post(text):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.post(f"{server.url}/predict", json={'text': text}, timeout=30)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    print(f"{n_requests} requests per level, {repeat_ratio:.0%} repeated texts")
+    print(f"{'clients':>8} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'batch':>6} {'hit %':>6}")
+    for concurrency in concurrency_levels:
+        with service._lock:
+            service._cache.clear()
+            service.stats = dict.fromkeys(service.stats, 0)
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = np.array(list(pool.map(post, texts))) * 1000
+        elapsed = time.perf_counter() - start_time
+        stats = service.stats
+        batch = stats['batched_texts'] / stats['batches'] if stats['batches'] else 0.0
+        hit_rate = stats['cache_hits'] / stats['requests'] * 100 if stats['requests'] else 0.0
+        print(f"{concurrency:>8} {np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} "
+              f"{n_requests / elapsed:>8.0f} {batch:>6.1f} {hit_rate:>6.1f}")
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the score model, or serve and benchmark predictions.")
+    parser.add_argument('--serve', action='store_true', help="serve predictions over HTTP until interrupted")
+    parser.add_argument('--benchmark', action='store_true', help="load-test the HTTP service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--alpha', type=float, default=1.0, help="ridge regularization strength")
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help="longest a request waits for its batch to fill")
+    parser.add_argument('--cache-size', type=int, default=4096)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--requests', type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument('--repeat-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not args.serve and not args.benchmark:
+        start_run('06')
+        start_time = time.perf_counter()
+        bundle = train_model(alpha=args.alpha)
+        with span('io.save_model'):
+            save_model(bundle)
+        metrics = bundle['metrics']
+        print(f"Trained on {metrics['reviews']} reviews in {time.perf_counter() - start_time:.1f}s: "
+              f"test MAE {metrics['test_mae']:.2f} (mean-score baseline {metrics['baseline_mae']:.2f}).")
+        return
+
+    service = ScoringService.from_file(max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                                       cache_size=args.cache_size)
+    with service:
+        if args.benchmark:
+            run_benchmark(service, args.concurrency, args.requests, args.repeat_ratio)
+            return
+        server = start_server(service, args.host, args.port)
+        print(f"Scoring service listening on {server.url} (POST /predict, GET /health)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+
+if __name__ == '__main__':
+    main()
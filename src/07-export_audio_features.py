@@ -0,0 +1,224 @@
+"""Columnar export of the Spotify audio features for the dashboard.
+
+Flattens data/spotify_features/<video_id>.json into one typed row per track,
+joined with the review's publish date and album score from data/processed,
+and writes them as Parquet partitioned by review year:
+
+    data/exports/audio_features/review_year=2019/part-0.parquet
+
+Readers only decode the columns and years they ask for, e.g. in R:
+
+    arrow::open_dataset("data/exports/audio_features") %>% select(album_score, energy) %>% collect()
+
+The export is incremental: `_manifest.json` (skipped by dataset readers)
+records the size and mtime of every source file and the review fields it was
+joined with, so a run only flattens new or changed files and rewrites the
+year partitions they touch.
+"""
+import os
+import json
+import time
+import datetime
+import argparse
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from video_records import iter_videos, parse_score
+from store_files import load_json, save_json
+from instrumentation import start_run, span, count
+
+# Define paths
+spotify_features_dir = 'data/spotify_features'
+processed_data_dir = 'data/processed/'
+export_dir = 'data/exports/audio_features'
+MANIFEST_FILE = '_manifest.json'
+
+# Directory name arrow reads back as a null review year
+UNKNOWN_YEAR = '__HIVE_DEFAULT_PARTITION__'
+
+AUDIO_FEATURES = [
+    ('danceability', pa.float32()),
+    ('energy', pa.float32()),
+    ('key', pa.int8()),
+    ('loudness', pa.float32()),
+    ('mode', pa.int8()),
+    ('speechiness', pa.float32()),
+    ('acousticness', pa.float32()),
+    ('instrumentalness', pa.float32()),
+    ('liveness', pa.float32()),
+    ('valence', pa.float32()),
+    ('tempo', pa.float32()),
+    ('duration_ms', pa.int32()),
+    ('time_signature', pa.int8()),
+]
+
+# Columns of each partition file; review_year is encoded in the directory name
+SCHEMA = pa.schema([
+    ('video_id', pa.string()),
+    ('title', pa.string()),
+    ('published_at', pa.timestamp('s', tz='UTC')),
+    ('album_score', pa.float32()),
+    ('artist_popularity', pa.int16()),
+    ('artist_followers', pa.int64()),
+    ('artist_genres', pa.list_(pa.string())),
+    ('track_number', pa.int16()),
+    ('track_id', pa.string()),
+    ('track_name', pa.string()),
+] + AUDIO_FEATURES)
+
+
+# Function to read the fields of every processed review the export joins on
+def load_reviews(processed_dir=processed_data_dir):
+    reviews = {}
+    if not os.path.isdir(processed_dir):
+        return reviews
+    for name in sorted(os.listdir(processed_dir)):
+        if not name.endswith(('.json', '.ndjson')):
+            continue
+        for video in iter_videos(os.path.join(processed_dir, name)):
+            snippet = video.get('snippet', {})
+            score = parse_score(video.get('album_score'))
+            reviews[video['id']] = {
+                'title': snippet.get('title'),
+                'published_at': snippet.get('publishedAt'),
+                'album_score': score if score is not None and 0 <= score <= 10 else None,
+            }
+    return reviews
+
+def parse_timestamp(published_at):
+    if not published_at:
+        return None
+    return datetime.datetime.fromisoformat(published_at.replace('Z', '+00:00'))
+
+def review_year(review):
+    published_at = parse_timestamp((review or {}).get('published_at'))
+    return published_at.year if published_at else None
+
+def partition_dir(year, output_dir=export_dir):
+    return os.path.join(output_dir, f"review_year={UNKNOWN_YEAR if year is None else year}")
+
+
+def flatten(video_id, album_data, review):
+    """The rows of one spotify_features file, as a dict of columns"""
+    review = review or {}
+    artist = album_data.get('artist_info') or {}
+    columns = {field.name: [] for field in SCHEMA}
+    for number, track in enumerate(album_data.get('tracks', []), start=1):
+        # Spotify has no audio features for some tracks
+        features = track.get('audio_features') or {}
+        columns['video_id'].append(video_id)
+        columns['title'].append(review.get('title'))
+        columns['published_at'].append(parse_timestamp(review.get('published_at')))
+        columns['album_score'].append(review.get('album_score'))
+        columns['artist_popularity'].append(artist.get('popularity'))
+        columns['artist_followers'].append(artist.get('followers'))
+        columns['artist_genres'].append(artist.get('genres'))
+        columns['track_number'].append(number)
+        columns['track_id'].append(track.get('id'))
+        columns['track_name'].append(track.get('name'))
+        for name, _ in AUDIO_FEATURES:
+            columns[name].append(features.get(name))
+    return columns
+
+
+def load_manifest(output_dir=export_dir):
+    return load_json(os.path.join(output_dir, MANIFEST_FILE), {'files': {}})
+
+def save_manifest(manifest, output_dir=export_dir):
+    save_json(manifest, os.path.join(output_dir, MANIFEST_FILE))
+
+
+def rewrite_partition(year, drop_ids, new_tables, output_dir=export_dir):
+    """Replace the rows of `drop_ids` in one year's partition with `new_tables`; returns its row count"""
+    directory = partition_dir(year, output_dir)
+    path = os.path.join(directory, 'part-0.parquet')
+    tables = list(new_tables)
+    if os.path.exists(path):
+        with span('io.read_partition'):
+            existing = pq.read_table(path, schema=SCHEMA)
+        keep = pc.invert(pc.is_in(existing['video_id'], value_set=pa.array(sorted(drop_ids), pa.string())))
+        tables.insert(0, existing.filter(keep))
+    table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+    if table.num_rows == 0:
+        if os.path.exists(path):
+            os.remove(path)
+            os.rmdir(directory)
+        return 0
+    table = table.sort_by([('published_at', 'ascending'), ('video_id', 'ascending'), ('track_number', 'ascending')])
+    os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    with span('io.write_partition'):
+        pq.write_table(table, tmp_file, compression='zstd')
+        os.replace(tmp_file, path)
+    count('bytes.written', os.path.getsize(path))
+    return table.num_rows
+
+
+def export_audio_features(features_dir=spotify_features_dir, processed_dir=processed_data_dir, output_dir=export_dir):
+    """Bring the Parquet export up to date with features_dir; returns (files exported, rows written, years rewritten)"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    entries = manifest['files']
+    with span('parse.reviews'):
+        reviews = load_reviews(processed_dir)
+
+    # Source files keyed by video ID, with what they were last exported from
+    current = {}
+    for name in sorted(os.listdir(features_dir)) if os.path.isdir(features_dir) else []:
+        if not name.endswith('.json'):
+            continue
+        stat = os.stat(os.path.join(features_dir, name))
+        video_id = name[:-len('.json')]
+        review = reviews.get(video_id)
+        current[video_id] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'review': review,
+                             'year': review_year(review)}
+
+    changed = [video_id for video_id, entry in current.items() if entries.get(video_id) != entry]
+    removed = [video_id for video_id in entries if video_id not in current]
+    if not changed and not removed:
+        return 0, 0, []
+
+    # Group the new rows by the partition they belong in
+    new_tables = {}
+    for video_id in changed:
+        with span('parse.features_file'), open(os.path.join(features_dir, f"{video_id}.json"), 'r') as file:
+            album_data = json.load(file)
+            count('bytes.read', file.tell())
+            table = pa.Table.from_pydict(flatten(video_id, album_data, current[video_id]['review']), schema=SCHEMA)
+        new_tables.setdefault(current[video_id]['year'], []).append(table)
+
+    # A changed file may have moved between years, so clear it from its old partition too
+    drop_ids = set(changed) | set(removed)
+    years = set(new_tables) | {entries[video_id]['year'] for video_id in drop_ids if video_id in entries}
+    rows = 0
+    for year in sorted(years, key=lambda year: (year is None, year)):
+        rewrite_partition(year, drop_ids, new_tables.get(year, []), output_dir)
+        rows += sum(table.num_rows for table in new_tables.get(year, []))
+
+    # The manifest is written last, so an interrupted run redoes the same files
+    manifest['files'] = current
+    save_manifest(manifest, output_dir)
+    return len(changed), rows, sorted(years, key=lambda year: (year is None, year))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Spotify audio features as Parquet, partitioned by review year.")
+    parser.add_argument('--rebuild', action='store_true', help="re-export every file instead of only new or changed ones")
+    args = parser.parse_args()
+    start_run('07')
+
+    start_time = time.time()
+    if args.rebuild and os.path.isdir(export_dir):
+        shutil.rmtree(export_dir)
+    exported, rows, years = export_audio_features()
+    count('items.processed', exported)
+    if not exported and not years:
+        print(f"Audio features export is up to date ({time.time() - start_time:.2f}s).")
+        return
+    years = ', '.join('unknown' if year is None else str(year) for year in years)
+    print(f"Exported {exported} changed files ({rows} tracks) into year partitions {years} "
+          f"in {time.time() - start_time:.2f}s.")
+
+if __name__ == '__main__':
+    main()
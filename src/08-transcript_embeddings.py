@@ -0,0 +1,333 @@
+"""Transcript embeddings for the BERT model track, computed on CPU.
+
+Transcripts are far longer than BERT's 512-token limit, so each one is split
+into overlapping token windows. Every window is encoded and mean-pooled, and a
+review's embedding is the mean of its windows weighted by their token counts.
+
+Reviews are sorted by length and sent in chunks to a process pool. Each worker
+loads the model once and maps the corpus itself, so only video IDs and vectors
+cross process boundaries. Within a chunk, windows are sorted by length and
+batched under a token budget, so batches carry little padding.
+
+Embeddings are stored under data/embeddings, keyed by the SHA-256 of the
+transcript text, so only new or changed transcripts are ever encoded:
+
+    embeddings.f32   float32 matrix with one row per distinct transcript text
+    keys.ndjson      one {"video_id", "hash", "row"} line per embedded video; later lines win
+    manifest.json    model settings and the committed sizes of both files
+
+Both data files are append-only, and manifest.json is the commit point, as in
+corpus_store. Changing the model or window settings starts a new store.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+from corpus_store import TranscriptCorpus
+from store_files import load_json, save_json, map_array
+from instrumentation import start_run, span, count, progress_bar
+
+# Define the directory paths
+corpus_dir = 'data/corpus'
+embeddings_dir = 'data/embeddings'
+
+EMBEDDINGS_FILE = 'embeddings.f32'
+KEYS_FILE = 'keys.ndjson'
+MANIFEST_FILE = 'manifest.json'
+
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+MODEL_NAME = 'bert-base-uncased'
+# Transcript tokens per window, leaving room for [CLS] and [SEP]
+WINDOW_TOKENS = 510
+# Tokens shared by consecutive windows, so no sentence is only seen cut in half
+OVERLAP_TOKENS = 128
+# Upper bound on padded tokens per forward pass
+BATCH_TOKENS = 8192
+
+
+def load_manifest(embeddings_dir):
+    return load_json(os.path.join(embeddings_dir, MANIFEST_FILE))
+
+def save_manifest(manifest, embeddings_dir):
+    save_json(manifest, os.path.join(embeddings_dir, MANIFEST_FILE))
+
+# Function to read the committed keys: content hash -> row, and video ID -> (hash, row)
+def load_keys(embeddings_dir, manifest):
+    rows, videos = {}, {}
+    if not manifest or not manifest['keys_bytes']:
+        return rows, videos
+    with open(os.path.join(embeddings_dir, KEYS_FILE), 'rb') as file:
+        for line in file.read(manifest['keys_bytes']).splitlines():
+            entry = json.loads(line)
+            rows[entry['hash']] = entry['row']
+            videos[entry['video_id']] = (entry['hash'], entry['row'])
+    return rows, videos
+
+def content_hash(raw_text):
+    return hashlib.sha256(raw_text).hexdigest()
+
+
+class EmbeddingStore:
+    """Append-only embedding matrix keyed by transcript content hash.
+
+    Opening the store for writing discards anything written after the last
+    commit, and starts over when the stored settings differ from `settings`.
+    A `readonly` store only sees the last commit and never touches the files,
+    so it is safe to open while a writer appends.
+    """
+
+    def __init__(self, embeddings_dir=embeddings_dir, settings=None, readonly=False):
+        self.embeddings_dir = embeddings_dir
+        self.readonly = readonly
+        manifest = load_manifest(embeddings_dir)
+        if readonly:
+            manifest = manifest or {'settings': None, 'dim': None, 'n_rows': 0, 'keys_bytes': 0}
+        else:
+            os.makedirs(embeddings_dir, exist_ok=True)
+            if manifest is None or (settings is not None and manifest['settings'] != settings):
+                if manifest is not None:
+                    print(f"Embedding settings changed from {manifest['settings']}; re-encoding every transcript.")
+                manifest = {'settings': settings, 'dim': None, 'n_rows': 0, 'keys_bytes': 0}
+                self._reset(manifest)
+        self.manifest = manifest
+        if not readonly:
+            self._discard_uncommitted()
+        self.rows, self.videos = load_keys(embeddings_dir, manifest)
+
+    def _reset(self, manifest):
+        # Commit the empty manifest before dropping the data, so no manifest ever
+        # points past the end of the files. Unlinking rather than truncating
+        # keeps the old data valid for readers that already mapped it.
+        save_manifest(manifest, self.embeddings_dir)
+        for name in (EMBEDDINGS_FILE, KEYS_FILE):
+            path = os.path.join(self.embeddings_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _discard_uncommitted(self):
+        dim = self.manifest['dim'] or 0
+        sizes = {
+            EMBEDDINGS_FILE: self.manifest['n_rows'] * dim * EMBEDDING_DTYPE.itemsize,
+            KEYS_FILE: self.manifest['keys_bytes'],
+        }
+        for name, size in sizes.items():
+            with open(os.path.join(self.embeddings_dir, name), 'ab') as file:
+                file.truncate(size)
+
+    def is_current(self, video_id, text_hash):
+        return self.videos.get(video_id, (None,))[0] == text_hash
+
+    def append(self, entries):
+        """Commit (video_id, hash, vector) triples; vectors of texts already stored are not written again"""
+        if self.readonly:
+            raise RuntimeError(f"Embedding store in {self.embeddings_dir} was opened read-only")
+        vectors, key_lines = [], []
+        n_rows = self.manifest['n_rows']
+        for video_id, text_hash, vector in entries:
+            row = self.rows.get(text_hash)
+            if row is None:
+                row = n_rows
+                n_rows += 1
+                vectors.append(np.asarray(vector, dtype=EMBEDDING_DTYPE))
+                self.rows[text_hash] = row
+            self.videos[video_id] = (text_hash, row)
+            key_lines.append(json.dumps({'video_id': video_id, 'hash': text_hash, 'row': row}) + '\n')
+        if not key_lines:
+            return
+
+        def append(name, data):
+            with open(os.path.join(self.embeddings_dir, name), 'ab') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+                return file.tell()
+
+        if vectors:
+            self.manifest['dim'] = len(vectors[0])
+            append(EMBEDDINGS_FILE, np.stack(vectors).tobytes())
+        keys_bytes = append(KEYS_FILE, ''.join(key_lines).encode('utf-8'))
+        self.manifest.update(n_rows=n_rows, keys_bytes=keys_bytes)
+        save_manifest(self.manifest, self.embeddings_dir)
+
+    def matrix(self):
+        """The committed embeddings as a read-only (n_rows, dim) memory map"""
+        return map_array(os.path.join(self.embeddings_dir, EMBEDDINGS_FILE), EMBEDDING_DTYPE,
+                         (self.manifest['n_rows'], self.manifest['dim'] or 0))
+
+
+def load_embeddings(embeddings_dir=embeddings_dir):
+    """Video IDs and their embeddings, as a list and an (n_videos, dim) array"""
+    store = EmbeddingStore(embeddings_dir, readonly=True)
+    video_ids = sorted(store.videos)
+    rows = [store.videos[video_id][1] for video_id in video_ids]
+    return video_ids, np.asarray(store.matrix()[rows])
+
+
+# Function to split a review's token IDs into windows that overlap by `overlap` tokens
+def token_windows(token_ids, window=WINDOW_TOKENS, overlap=OVERLAP_TOKENS):
+    if len(token_ids) <= window:
+        return [token_ids]
+    step = window - overlap
+    return [token_ids[start:start + window] for start in range(0, len(token_ids) - overlap, step)]
+
+# Function to group windows sorted by length into batches of at most `batch_tokens` padded tokens
+def length_batches(windows, batch_tokens=BATCH_TOKENS):
+    batch, padded_length = [], 0
+    for window in sorted(windows, key=lambda window: len(window[1]), reverse=True):
+        # Sorted longest first, so the first window of a batch sets its padded length
+        padded_length = padded_length or len(window[1]) + 2
+        if batch and (len(batch) + 1) * padded_length > batch_tokens:
+            yield batch
+            batch, padded_length = [], len(window[1]) + 2
+        batch.append(window)
+    if batch:
+        yield batch
+
+
+# Per-process model, tokenizer and corpus, set up once by init_worker
+_worker = {}
+
+def init_worker(model_name, corpus_dir, threads):
+    torch.set_num_threads(threads)
+    _worker['tokenizer'] = AutoTokenizer.from_pretrained(model_name)
+    _worker['model'] = AutoModel.from_pretrained(model_name).eval()
+    _worker['corpus'] = TranscriptCorpus(corpus_dir)
+
+def encode_batch(batch):
+    """Mean-pooled last hidden states of a batch of windows, as a (len(batch), dim) array"""
+    tokenizer, model = _worker['tokenizer'], _worker['model']
+    length = max(len(token_ids) for _, token_ids in batch) + 2
+    input_ids = np.full((len(batch), length), tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(batch), length), dtype=np.int64)
+    for i, (_, token_ids) in enumerate(batch):
+        ids = [tokenizer.cls_token_id] + list(token_ids) + [tokenizer.sep_token_id]
+        input_ids[i, :len(ids)] = ids
+        attention_mask[i, :len(ids)] = 1
+    mask = torch.from_numpy(attention_mask)
+    with torch.inference_mode():
+        hidden = model(input_ids=torch.from_numpy(input_ids), attention_mask=mask).last_hidden_state
+        mask = mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+    return pooled.numpy()
+
+def embed_reviews(video_ids, window=WINDOW_TOKENS, overlap=OVERLAP_TOKENS, batch_tokens=BATCH_TOKENS):
+    """Embed a chunk of reviews in a worker; returns (video_id, vector, tokens, windows) tuples and the seconds spent"""
+    start_time = time.perf_counter()
+    texts = [_worker['corpus'].text(video_id) for video_id in video_ids]
+    token_ids = _worker['tokenizer'](texts, add_special_tokens=False, return_attention_mask=False,
+                                     verbose=False)['input_ids']
+    windows = [(i, ids) for i, review_ids in enumerate(token_ids) for ids in token_windows(review_ids, window, overlap)]
+
+    # Each review's embedding is the token-weighted mean of its window embeddings
+    sums, weights, counts = {}, np.zeros(len(video_ids)), [0] * len(video_ids)
+    for batch in length_batches(windows, batch_tokens):
+        for (i, ids), pooled in zip(batch, encode_batch(batch)):
+            sums[i] = sums.get(i, 0) + pooled * len(ids)
+            weights[i] += len(ids)
+            counts[i] += 1
+    results = []
+    for i, video_id in enumerate(video_ids):
+        vector = sums[i] / weights[i] if weights[i] else None
+        results.append((video_id, vector, len(token_ids[i]), counts[i]))
+    return results, time.perf_counter() - start_time
+
+
+def update_embeddings(corpus_dir=corpus_dir, embeddings_dir=embeddings_dir, model_name=MODEL_NAME,
+                      workers=1, threads=1, chunk_size=8, batch_tokens=BATCH_TOKENS, commit_every=64, limit=None):
+    """Embed the corpus transcripts whose text is not in the store yet; returns run statistics"""
+    settings = {'model': model_name, 'window_tokens': WINDOW_TOKENS, 'overlap_tokens': OVERLAP_TOKENS,
+                'pooling': 'mean'}
+    store = EmbeddingStore(embeddings_dir, settings)
+    stats = {'reviews': 0, 'reused': 0, 'empty': 0, 'tokens': 0, 'windows': 0, 'worker_seconds': 0.0}
+
+    with TranscriptCorpus(corpus_dir) as corpus, span('parse.content_hash'):
+        hashes = {video_id: content_hash(corpus.raw_text(video_id)) for video_id in corpus.video_ids}
+        changed = [video_id for video_id in corpus.video_ids if not store.is_current(video_id, hashes[video_id])]
+        # Same text under another video ID (e.g. a re-upload) needs no encoding
+        reused = [video_id for video_id in changed if hashes[video_id] in store.rows]
+        store.append((video_id, hashes[video_id], None) for video_id in reused)
+        stats['reused'] = len(reused)
+        pending = [video_id for video_id in changed
+                   if hashes[video_id] not in store.rows and len(corpus.raw_text(video_id))]
+        # Chunks of similar-length reviews keep the windows of a chunk alike in length
+        pending.sort(key=lambda video_id: len(corpus.raw_text(video_id)))
+        pending = pending[:limit] if limit else pending
+    if not pending:
+        return stats
+
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    buffer = []
+    progress = progress_bar('reviews', total=len(pending))
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_name, corpus_dir, threads)) as pool:
+        running = set()
+        while chunks or running:
+            # Keep a couple of chunks queued per worker without submitting the whole backlog;
+            # the longest chunks go first so they do not hold up the end of the run
+            while chunks and len(running) < 2 * workers:
+                running.add(pool.submit(embed_reviews, chunks.pop(), WINDOW_TOKENS, OVERLAP_TOKENS, batch_tokens))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, seconds = future.result()
+                stats['worker_seconds'] += seconds
+                # Workers record no spans of their own, so their time is counted here
+                count('embed.worker_seconds', seconds)
+                progress.update(len(results))
+                for video_id, vector, n_tokens, n_windows in results:
+                    if vector is None:
+                        stats['empty'] += 1
+                        continue
+                    buffer.append((video_id, hashes[video_id], vector))
+                    stats['reviews'] += 1
+                    stats['tokens'] += n_tokens
+                    stats['windows'] += n_windows
+            if len(buffer) >= commit_every:
+                with span('io.store_append'):
+                    store.append(buffer)
+                buffer = []
+    with span('io.store_append'):
+        store.append(buffer)
+    progress.close()
+    count('embed.tokens', stats['tokens'])
+    count('embed.windows', stats['windows'])
+    stats['seconds'] = time.perf_counter() - start_time
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed review transcripts with BERT on CPU.")
+    parser.add_argument('--model', default=MODEL_NAME, help="Hugging Face model name (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="processes, each with its own copy of the model")
+    parser.add_argument('--threads', type=int, default=2, help="torch threads per worker")
+    parser.add_argument('--chunk-size', type=int, default=8, help="reviews per task sent to a worker")
+    parser.add_argument('--batch-tokens', type=int, default=BATCH_TOKENS, help="padded tokens per forward pass")
+    parser.add_argument('--limit', type=int, help="embed at most this many reviews, e.g. to time a sample")
+    args = parser.parse_args()
+    start_run('08')
+
+    stats = update_embeddings(corpus_dir, embeddings_dir, args.model, args.workers, args.threads,
+                              args.chunk_size, args.batch_tokens, limit=args.limit)
+    if stats['reused']:
+        print(f"Reused stored embeddings for {stats['reused']} videos with unchanged text.")
+    count('items.processed', stats['reviews'])
+    if not stats['reviews']:
+        print("Transcript embeddings are up to date.")
+        return
+    seconds = stats['seconds']
+    print(f"Embedded {stats['reviews']} reviews ({stats['tokens']} tokens in {stats['windows']} windows) "
+          f"with {args.workers} workers x {args.threads} threads in {seconds:.1f}s: "
+          f"{stats['tokens'] / seconds:.0f} tokens/s, {seconds / stats['reviews']:.2f}s per review "
+          f"({stats['worker_seconds'] / stats['reviews']:.2f} worker-seconds per review).")
+    if stats['empty']:
+        print(f"Skipped {stats['empty']} transcripts without tokens.")
+
+if __name__ == '__main__':
+    main()
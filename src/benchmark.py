@@ -0,0 +1,529 @@
+"""Offline benchmark of the data stages against local stand-ins for the APIs.
+
+Each stage's real `main()` runs in a fresh interpreter inside a temporary
+working directory, with the YouTube Data API and Spotify clients replaced by
+in-process fakes and transcripts served by fake_transcript_server. The fakes
+paginate like the real APIs, sleep a configurable latency per call, and can
+inject errors and throttling (403 rateLimitExceeded / quotaExceeded for
+YouTube, 429 for Spotify and the transcript server).
+
+For every corpus size the suite runs 01 to 04 in order and reports wall
+time, items per second, API calls issued, bytes returned and peak resident
+memory. Results can be saved with --output and checked against an earlier
+run with --baseline, which fails when a stage issues more API calls or uses
+noticeably more memory than before.
+
+--processing N benchmarks 02's score extraction on its own: a synthetic dump
+of N videos is processed with one worker and with a full process pool, each
+in a fresh interpreter so peak memory is measured separately.
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+import httplib2
+from googleapiclient.errors import HttpError
+from spotipy import SpotifyException
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+STAGE_SCRIPTS = {
+    '01': '01-data_acquisition',
+    '02': '02-data_processing',
+    '03': '03-data_get_transcripts',
+    '04': '04-data_get_spotify_features',
+}
+# Ledger stage whose statuses count as the items a benchmark stage processed
+STAGE_ITEMS = {'01': 'fetch', '02': 'process', '03': 'transcript', '04': 'spotify'}
+
+# Memory growth over the baseline tolerated before --baseline reports a regression
+MEMORY_TOLERANCE = 1.2
+
+
+# Function to build one synthetic upload, shaped like a videos.list item; index 0 is the newest
+def synthetic_video(index):
+    rng = random.Random(index)
+    kind = rng.random()
+    if kind < 0.6:
+        title = f"Artist {index % 997} - Album {index} ALBUM REVIEW"
+        score = f"\n\n{rng.choice(['light ', 'decent ', 'strong ', ''])}{rng.randint(1, 10)}/10"
+    elif kind < 0.9:
+        title = f"Artist {index % 997} - Track {index} TRACK REVIEW"
+        score = ''
+    else:
+        title = f"Weekly Track Roundup: {index}"
+        score = ''
+    published = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1700000000 - index * 86400 // 3))
+    return {
+        'kind': 'youtube#video',
+        'etag': hashlib.md5(str(index).encode()).hexdigest(),
+        'id': f"v{index:010d}",
+        'snippet': {
+            'publishedAt': published,
+            'channelId': 'UCt7fwAhXDy3oNFTAzF2o8Pw',
+            'title': title,
+            'description': ("Listen: https://example.bandcamp.com/album/x\n\n" + "Lorem ipsum dolor sit amet. " * rng.randint(10, 60)
+                            + score + "\n\nY'all know this is just my opinion, right?\n" + "=" * 35),
+            'thumbnails': {size: {'url': f"https://i.ytimg.com/vi/{index}/{size}.jpg", 'width': 120, 'height': 90}
+                           for size in ('default', 'medium', 'high', 'standard', 'maxres')},
+            'channelTitle': 'theneedledrop',
+            'tags': ['album', 'review'],
+            'categoryId': '10',
+        },
+        'contentDetails': {'duration': f"PT{rng.randint(3, 20)}M{rng.randint(0, 59)}S", 'dimension': '2d',
+                           'definition': 'hd', 'caption': 'false'},
+        'statistics': {'viewCount': str(rng.randint(1000, 10 ** 6)), 'likeCount': str(rng.randint(10, 10 ** 4)),
+                       'favoriteCount': '0', 'commentCount': str(rng.randint(0, 5000))},
+    }
+
+
+# Function to parse a partial-response mask such as "items(id,snippet/title)" into a tree of fields
+def parse_fields(spec):
+    pos = 0
+
+    def parse_list(closing):
+        nonlocal pos
+        tree = {}
+        while pos < len(spec) and spec[pos] != closing:
+            merge_fields(tree, parse_path())
+            if pos < len(spec) and spec[pos] == ',':
+                pos += 1
+        pos += 1
+        return tree
+
+    def parse_path():
+        nonlocal pos
+        start = pos
+        while pos < len(spec) and spec[pos] not in ',/()':
+            pos += 1
+        name = spec[start:pos].strip()
+        if pos < len(spec) and spec[pos] == '/':
+            pos += 1
+            return {name: parse_path()}
+        if pos < len(spec) and spec[pos] == '(':
+            pos += 1
+            return {name: parse_list(')')}
+        return {name: {}}
+
+    return parse_list(None)
+
+def merge_fields(tree, other):
+    for name, subtree in other.items():
+        if name in tree and tree[name] and subtree:
+            merge_fields(tree[name], subtree)
+        else:
+            # An empty subtree selects the whole field
+            tree[name] = {} if name in tree else subtree
+
+# Function to keep only the fields selected by a parsed mask
+def apply_fields(value, tree):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {name: apply_fields(value[name], subtree) for name, subtree in tree.items() if name in value}
+    return value
+
+
+class FakeAPI:
+    """Shared call accounting, latency and error injection for the client fakes"""
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.bytes = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, endpoint):
+        """Count a call and wait out its latency; returns True if an error should be injected"""
+        with self._lock:
+            self.calls[endpoint] += 1
+            failed = self.error_rate and self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        return failed
+
+    def respond(self, response):
+        size = len(json.dumps(response, separators=(',', ':')))
+        with self._lock:
+            self.bytes += size
+        return response
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'api_calls': sum(self.calls.values()), 'bytes': self.bytes}
+
+
+class _Request:
+    def __init__(self, execute):
+        self.execute = execute
+
+
+class _Resource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeYouTube(FakeAPI):
+    """Stand-in for the googleapiclient YouTube resource: playlistItems().list and videos().list.
+
+    The uploads playlist holds `n_videos` synthetic uploads, newest first.
+    Calls beyond `rate_limit` per second answer 403 rateLimitExceeded, and
+    calls beyond `quota` units answer 403 quotaExceeded, as the real API does.
+    """
+
+    PAGE_SIZE = 50
+
+    def __init__(self, n_videos, latency=0.05, error_rate=0.0, rate_limit=None, quota=None, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.n_videos = n_videos
+        self.rate_limit = rate_limit
+        self.quota = quota
+        self.units = 0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def _error(self, status, reason, uri):
+        content = json.dumps({'error': {'code': status, 'message': reason,
+                                        'errors': [{'message': reason, 'domain': 'youtube.quota', 'reason': reason}]}})
+        return HttpError(httplib2.Response({'status': status, 'reason': 'Forbidden'}), content.encode(), uri=uri)
+
+    def _check(self, endpoint):
+        with self._lock:
+            self.units += 1
+            if self.quota is not None and self.units > self.quota:
+                self.calls[endpoint] += 1
+                raise self._error(403, 'quotaExceeded', endpoint)
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            throttled = self.rate_limit and self._window_count > self.rate_limit
+        if self.call(endpoint) or throttled:
+            raise self._error(403, 'rateLimitExceeded', endpoint)
+
+    def _respond(self, response, parts, fields):
+        # Like the API, only the requested parts are returned, narrowed further by the fields mask
+        for item in response['items']:
+            for part in ('snippet', 'contentDetails', 'statistics'):
+                if part not in parts:
+                    item.pop(part, None)
+        if fields:
+            response = apply_fields(response, parse_fields(fields))
+        return self.respond(response)
+
+    def playlistItems(self):
+        def list_(part, playlistId, maxResults=5, pageToken=None, fields=None, **kwargs):
+            def execute():
+                self._check('playlistItems.list')
+                start = int(pageToken[len('page'):]) if pageToken else 0
+                end = min(start + min(maxResults, self.PAGE_SIZE), self.n_videos)
+                items = [{'kind': 'youtube#playlistItem',
+                          'snippet': {'playlistId': playlistId, 'position': i,
+                                      'title': synthetic_video(i)['snippet']['title'],
+                                      'resourceId': {'kind': 'youtube#video', 'videoId': f"v{i:010d}"}}}
+                         for i in range(start, end)]
+                response = {'kind': 'youtube#playlistItemListResponse', 'items': items,
+                            'pageInfo': {'totalResults': self.n_videos, 'resultsPerPage': self.PAGE_SIZE}}
+                if end < self.n_videos:
+                    response['nextPageToken'] = f"page{end}"
+                return self._respond(response, part.split(','), fields)
+            return _Request(execute)
+        return _Resource(list=list_)
+
+    def videos(self):
+        def list_(part, id, fields=None, **kwargs):
+            def execute():
+                self._check('videos.list')
+                ids = id.split(',')
+                if len(ids) > self.PAGE_SIZE:
+                    raise self._error(400, 'tooManyIds', 'videos.list')
+                items = [synthetic_video(int(video_id[1:])) for video_id in ids]
+                return self._respond({'kind': 'youtube#videoListResponse', 'items': items}, part.split(','), fields)
+            return _Request(execute)
+        return _Resource(list=list_)
+
+
+class FakeSpotify(FakeAPI):
+    """Stand-in for spotipy.Spotify covering search and the bulk album, artist and audio feature endpoints.
+
+    A share of searches (`miss_ratio`) find nothing; artists are shared
+    between albums, as in the real catalogue. Oversized bulk requests fail
+    like they do against the real API.
+    """
+
+    LIMITS = {'albums': 20, 'artists': 50, 'audio_features': 100}
+
+    def __init__(self, latency=0.05, error_rate=0.0, miss_ratio=0.1, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.miss_ratio = miss_ratio
+
+    def _check(self, endpoint, ids=None):
+        if self.call(endpoint):
+            raise SpotifyException(429, -1, 'API rate limit exceeded', headers={'Retry-After': '1'})
+        if ids is not None and len(ids) > self.LIMITS[endpoint]:
+            raise SpotifyException(400, -1, f"Too many ids requested for {endpoint}")
+
+    def search(self, q, type='album', limit=10, **kwargs):
+        self._check('search')
+        digest = hashlib.sha256(q.encode()).hexdigest()
+        if int(digest[:4], 16) / 0xFFFF < self.miss_ratio:
+            return self.respond({'albums': {'items': []}})
+        artist_id = f"artist{int(digest[4:8], 16) % 2000:05d}"
+        return self.respond({'albums': {'items': [{'id': f"album{digest[:16]}", 'name': q,
+                                                   'artists': [{'id': artist_id, 'name': artist_id}]}]}})
+
+    def albums(self, albums, **kwargs):
+        self._check('albums', albums)
+        result = []
+        for album_id in albums:
+            n_tracks = 6 + int(album_id[-2:], 16) % 10
+            tracks = [{'id': f"{album_id}t{i:02d}", 'name': f"Track {i}"} for i in range(n_tracks)]
+            result.append({'id': album_id, 'tracks': {'items': tracks}})
+        return self.respond({'albums': result})
+
+    def artists(self, artists):
+        self._check('artists', artists)
+        return self.respond({'artists': [{
+            'id': artist_id, 'popularity': 50, 'followers': {'total': 1000}, 'genres': ['rock'],
+            'images': [], 'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"},
+            'uri': f"spotify:artist:{artist_id}"} for artist_id in artists]})
+
+    def audio_features(self, tracks=[]):
+        self._check('audio_features', tracks)
+        features = []
+        for track_id in tracks:
+            rng = random.Random(track_id)
+            features.append({'id': track_id, 'danceability': rng.random(), 'energy': rng.random(),
+                             'valence': rng.random(), 'tempo': rng.uniform(60, 180),
+                             'duration_ms': rng.randint(90000, 400000)})
+        return self.respond(features)
+
+
+def run_stage(stage, options):
+    """Run one stage's main() in the current directory with the APIs faked; returns its measurements"""
+    sys.path.insert(0, src_dir)
+    module = importlib.import_module(STAGE_SCRIPTS[stage])
+    from pipeline_state import open_ledger, video_ids_with_status
+    from instrumentation import current_run, peak_rss_mb
+
+    fake = server = None
+    argv = [module.__file__]
+    if stage == '01':
+        fake = FakeYouTube(options['videos'], options['latency'], options['youtube_error_rate'],
+                           options['youtube_rate_limit'], options['youtube_quota'])
+        module.get_authenticated_service = lambda cache=None: fake
+        argv += ['--no-http-cache']
+    elif stage == '03':
+        from fake_transcript_server import start_server
+        server = start_server(latency=options['latency'], missing_ratio=0.1,
+                              error_rate=options['transcript_error_rate'], rate_limit=options['transcript_rate_limit'])
+        argv += ['--transcript-server', server.url, '--workers', str(options['workers']), '--rps', '0']
+    elif stage == '04':
+        fake = FakeSpotify(options['latency'], options['spotify_error_rate'])
+        module.get_spotify_client = lambda cache=None: fake
+        argv += ['--workers', str(options['workers']), '--rps', '0', '--no-http-cache']
+
+    def items():
+        ledger = open_ledger()
+        try:
+            return len(video_ids_with_status(ledger, STAGE_ITEMS[stage]))
+        finally:
+            ledger.close()
+
+    before = items()
+    sys.argv = argv
+    start_time = time.perf_counter()
+    # Stages print progress and a metrics report; only the measurements matter here
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        module.main()
+        summary = current_run().finish()
+    elapsed = time.perf_counter() - start_time
+
+    result = {'stage': stage, 'seconds': elapsed, 'items': items() - before, 'peak_mb': peak_rss_mb(children=True),
+              'spans': {name: span['total'] for name, span in summary['spans'].items()},
+              'counters': summary['counters']}
+    if fake is not None:
+        result.update(fake.stats())
+    if server is not None:
+        result.update({'calls': {'transcript': server.stats['requests']}, 'api_calls': server.stats['requests'],
+                       'bytes': None, 'throttled': server.stats['throttled']})
+        server.shutdown()
+    return result
+
+
+def run_suite(sizes, stages, options):
+    results = []
+    print(f"{'videos':>8} {'stage':>5} {'seconds':>8} {'items':>7} {'items/s':>8} {'calls':>7} {'MB in':>7} {'peak MB':>8}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for stage in stages:
+                stage_options = dict(options, videos=size)
+                completed = subprocess.run([sys.executable, __file__, 'run-stage', stage, json.dumps(stage_options)],
+                                           cwd=work_dir, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stderr, file=sys.stderr)
+                    raise SystemExit(f"Stage {stage} failed at {size} videos")
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                result['videos'] = size
+                results.append(result)
+                rate = result['items'] / result['seconds'] if result['seconds'] else 0.0
+                received = f"{result['bytes'] / 1e6:.1f}" if result.get('bytes') is not None else '-'
+                print(f"{size:>8} {stage:>5} {result['seconds']:>8.2f} {result['items']:>7} {rate:>8.1f} "
+                      f"{result.get('api_calls', 0):>7} {received:>7} {result['peak_mb']:>8.0f}", flush=True)
+    return results
+
+
+# Function to list regressions in API calls and peak memory against an earlier run
+def compare(results, baseline):
+    earlier = {(result['videos'], result['stage']): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = earlier.get((result['videos'], result['stage']))
+        if previous is None:
+            continue
+        label = f"{result['stage']} at {result['videos']} videos"
+        if result.get('api_calls', 0) > previous.get('api_calls', 0):
+            regressions.append(f"{label}: {previous.get('api_calls', 0)} -> {result['api_calls']} API calls")
+        if result['peak_mb'] > previous['peak_mb'] * MEMORY_TOLERANCE:
+            regressions.append(f"{label}: peak memory {previous['peak_mb']:.0f} -> {result['peak_mb']:.0f} MB")
+    return regressions
+
+
+# Function to write a synthetic raw dump shaped like the YouTube API output
+def write_synthetic_dump(file_path, n_videos, seed):
+    rng = random.Random(seed)
+    adjectives = ['light', 'decent', 'strong', 'Strong', 'DECENT']
+    with open(file_path, 'w') as file:
+        file.write('[\n')
+        for i in range(n_videos):
+            is_review = rng.random() < 0.5
+            title = f"Artist {i} - Album {i} ALBUM REVIEW" if is_review else f"Artist {i} - Track {i} TRACK REVIEW"
+            score = f"{rng.choice(adjectives)} {rng.randint(1, 10)}/10" if is_review else ''
+            description = ("Listen: https://example.bandcamp.com/album/x\n\n" + "Lorem ipsum dolor sit amet. " * 40
+                           + f"\n\n{score}\n\nY'all know this is just my opinion, right?\n" + "=" * 35)
+            video = {
+                'kind': 'youtube#video',
+                'etag': f"etag{i}",
+                'id': f"syn{seed:02d}{i:08d}",
+                'snippet': {
+                    'publishedAt': '2023-11-04T19:00:22Z',
+                    'channelId': 'UCt7fwAhXDy3oNFTAzF2o8Pw',
+                    'title': title,
+                    'description': description,
+                    'thumbnails': {size: {'url': f"https://i.ytimg.com/vi/{i}/{size}.jpg", 'width': 120, 'height': 90}
+                                   for size in ('default', 'medium', 'high', 'standard', 'maxres')},
+                    'channelTitle': 'theneedledrop',
+                    'tags': ['album', 'review'],
+                },
+                'contentDetails': {'duration': 'PT8M2S', 'dimension': '2d', 'definition': 'hd', 'caption': 'false'},
+                'statistics': {'viewCount': '10537', 'likeCount': '495', 'favoriteCount': '0', 'commentCount': '27'},
+            }
+            file.write(('' if i == 0 else ',\n') + json.dumps(video, indent=4))
+        file.write('\n]\n')
+
+def run_processing_benchmark(n_videos, n_files):
+    """Time 02 on a synthetic dump with one worker and with a full pool"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = os.path.join(tmp_dir, 'raw')
+        os.makedirs(raw_dir)
+        per_file = -(-n_videos // n_files)
+        for seed in range(n_files):
+            count = min(per_file, n_videos - seed * per_file)
+            if count > 0:
+                write_synthetic_dump(os.path.join(raw_dir, f"video_data_{seed}.json"), count, seed)
+        dump_mb = sum(os.path.getsize(os.path.join(raw_dir, name)) for name in os.listdir(raw_dir)) / 1e6
+        print(f"Synthetic dump: {n_videos} videos in {n_files} files, {dump_mb:.0f} MB")
+        print(f"{'workers':>8} {'seconds':>8} {'videos/s':>10} {'peak MB':>8}")
+        for workers in sorted({1, os.cpu_count() or 1}):
+            output = subprocess.run([sys.executable, __file__, 'run-processing', raw_dir, str(workers)],
+                                    check=True, capture_output=True, text=True).stdout
+            elapsed, peak_mb = map(float, output.split())
+            print(f"{workers:>8} {elapsed:>8.2f} {n_videos / elapsed:>10.0f} {peak_mb:>8.0f}")
+
+def run_processing(raw_dir, workers):
+    """Process every dump in raw_dir with 02's worker pool; returns the seconds taken and peak MB"""
+    sys.path.insert(0, src_dir)
+    module = importlib.import_module(STAGE_SCRIPTS['02'])
+    from instrumentation import peak_rss_mb
+
+    output_dir = os.path.join(os.path.dirname(raw_dir), f"processed_{workers}")
+    os.makedirs(output_dir)
+    file_paths = [os.path.join(raw_dir, name) for name in os.listdir(raw_dir)]
+    start_time = time.perf_counter()
+    module.process_raw_files(file_paths, set(), workers, output_dir)
+    return time.perf_counter() - start_time, peak_rss_mb(children=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stages 01-04 offline against fake APIs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="uploads in the fake channel for each run, e.g. 1000 10000 100000")
+    parser.add_argument('--stages', nargs='+', choices=sorted(STAGE_SCRIPTS), default=sorted(STAGE_SCRIPTS),
+                        help="stages to run; later stages need the output of earlier ones")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake API latency per call in seconds")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent requests for 03 and 04")
+    parser.add_argument('--youtube-error-rate', type=float, default=0.0,
+                        help="share of YouTube calls answered 403 rateLimitExceeded")
+    parser.add_argument('--youtube-rate-limit', type=int, default=None, help="YouTube calls per second before 403s")
+    parser.add_argument('--youtube-quota', type=int, default=None, help="YouTube units before 403 quotaExceeded")
+    parser.add_argument('--transcript-error-rate', type=float, default=0.0, help="share of transcript calls answered 500")
+    parser.add_argument('--transcript-rate-limit', type=int, default=None, help="transcript calls per second before 429s")
+    parser.add_argument('--spotify-error-rate', type=float, default=0.0, help="share of Spotify calls answered 429")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="results JSON of an earlier run to check for regressions")
+    parser.add_argument('--processing', type=int, metavar='N', default=None,
+                        help="only benchmark 02's score extraction on a synthetic dump of N videos")
+    parser.add_argument('--processing-files', type=int, default=8,
+                        help="number of dumps the --processing videos are split over")
+    # Each measurement runs in a fresh interpreter through one of these commands
+    commands = parser.add_subparsers(dest='command', title="single measurements, used by the suite")
+    run_stage_parser = commands.add_parser('run-stage', help="run one stage against the fakes and print its results")
+    run_stage_parser.add_argument('stage', choices=sorted(STAGE_SCRIPTS))
+    run_stage_parser.add_argument('options', type=json.loads, help="suite options as JSON")
+    run_processing_parser = commands.add_parser('run-processing',
+                                                help="process a directory of dumps and print seconds and peak MB")
+    run_processing_parser.add_argument('raw_dir')
+    run_processing_parser.add_argument('workers', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'run-stage':
+        print(json.dumps(run_stage(args.stage, args.options)))
+        return
+    if args.command == 'run-processing':
+        print(*run_processing(args.raw_dir, args.workers))
+        return
+    if args.processing:
+        run_processing_benchmark(args.processing, args.processing_files)
+        return
+
+    options = {key: getattr(args, key) for key in (
+        'latency', 'workers', 'youtube_error_rate', 'youtube_rate_limit', 'youtube_quota',
+        'transcript_error_rate', 'transcript_rate_limit', 'spotify_error_rate')}
+    results = run_suite(args.sizes, args.stages, options)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Packed, memory-mapped store for the transcript corpus.
+
+The per-video files in data/transcripts are packed into a single directory:
+
+    text.bin               UTF-8 text of every segment, each followed by '\\n'
+    segment_offsets.i64    byte offset in text.bin where each segment starts
+    segment_starts.f32     segment start time in seconds
+    segment_durations.f32  segment duration in seconds
+    videos.ndjson          one {"video_id", "first_segment", "n_segments"} line per video
+    manifest.json          counts and file sizes of the committed data
+
+A video's segments are contiguous, so its full text is a single slice of
+text.bin. All files are append-only; manifest.json is replaced atomically
+after each append and is the commit point, so readers never see a partial
+append and a crashed append is discarded by the next one.
+
+Appends are not locked, so the corpus has a single writer: 03 packs new
+transcripts after fetching them, and later stages only read it. Transcript
+files added by hand are packed by running this module directly.
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+from instrumentation import span, count
+from store_files import load_json, save_json, map_array
+
+corpus_dir = 'data/corpus'
+transcripts_dir = 'data/transcripts'
+
+TEXT_FILE = 'text.bin'
+OFFSETS_FILE = 'segment_offsets.i64'
+STARTS_FILE = 'segment_starts.f32'
+DURATIONS_FILE = 'segment_durations.f32'
+VIDEOS_FILE = 'videos.ndjson'
+MANIFEST_FILE = 'manifest.json'
+
+OFFSET_DTYPE = np.dtype('<i8')
+TIME_DTYPE = np.dtype('<f4')
+
+
+def load_manifest(corpus_dir):
+    return load_json(os.path.join(corpus_dir, MANIFEST_FILE),
+                     {'version': 1, 'n_videos': 0, 'n_segments': 0, 'text_bytes': 0, 'videos_bytes': 0})
+
+def save_manifest(manifest, corpus_dir):
+    save_json(manifest, os.path.join(corpus_dir, MANIFEST_FILE))
+
+# Function to read the committed part of the video index
+def load_video_index(corpus_dir, manifest):
+    index = {}
+    path = os.path.join(corpus_dir, VIDEOS_FILE)
+    if not manifest['n_videos']:
+        return index
+    with open(path, 'r') as file:
+        for _ in range(manifest['n_videos']):
+            entry = json.loads(file.readline())
+            index[entry['video_id']] = (entry['first_segment'], entry['n_segments'])
+    return index
+
+
+# Function to truncate every data file back to the sizes recorded in the manifest
+def discard_uncommitted(corpus_dir, manifest):
+    sizes = {
+        TEXT_FILE: manifest['text_bytes'],
+        OFFSETS_FILE: manifest['n_segments'] * OFFSET_DTYPE.itemsize,
+        STARTS_FILE: manifest['n_segments'] * TIME_DTYPE.itemsize,
+        DURATIONS_FILE: manifest['n_segments'] * TIME_DTYPE.itemsize,
+        VIDEOS_FILE: manifest['videos_bytes'],
+    }
+    for name, size in sizes.items():
+        path = os.path.join(corpus_dir, name)
+        with open(path, 'ab') as file:
+            file.truncate(size)
+
+
+def append_transcripts(corpus_dir, transcripts):
+    """Append (video_id, transcript) pairs to the corpus, skipping videos already in it.
+
+    A transcript is the list of {"text", "start", "duration"} dicts returned
+    by YouTubeTranscriptApi. Returns the number of videos appended.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    manifest = load_manifest(corpus_dir)
+    discard_uncommitted(corpus_dir, manifest)
+    known = set(load_video_index(corpus_dir, manifest))
+
+    text_parts, offsets, starts, durations, index_lines = [], [], [], [], []
+    text_bytes = manifest['text_bytes']
+    n_segments = manifest['n_segments']
+    for video_id, transcript in transcripts:
+        if video_id in known:
+            continue
+        known.add(video_id)
+        first_segment = n_segments
+        for segment in transcript:
+            encoded = segment['text'].encode('utf-8') + b'\n'
+            offsets.append(text_bytes)
+            starts.append(segment['start'])
+            durations.append(segment['duration'])
+            text_parts.append(encoded)
+            text_bytes += len(encoded)
+            n_segments += 1
+        index_lines.append(json.dumps({'video_id': video_id, 'first_segment': first_segment,
+                                       'n_segments': n_segments - first_segment}) + '\n')
+    if not index_lines:
+        return 0
+
+    def append(name, data):
+        with span('io.corpus_append'), open(os.path.join(corpus_dir, name), 'ab') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+            count('bytes.written', len(data))
+            return file.tell()
+
+    append(TEXT_FILE, b''.join(text_parts))
+    append(OFFSETS_FILE, np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+    append(STARTS_FILE, np.asarray(starts, dtype=TIME_DTYPE).tobytes())
+    append(DURATIONS_FILE, np.asarray(durations, dtype=TIME_DTYPE).tobytes())
+    videos_bytes = append(VIDEOS_FILE, ''.join(index_lines).encode('utf-8'))
+
+    manifest.update(n_videos=manifest['n_videos'] + len(index_lines), n_segments=n_segments,
+                    text_bytes=text_bytes, videos_bytes=videos_bytes)
+    save_manifest(manifest, corpus_dir)
+    return len(index_lines)
+
+
+# Function to stream transcripts from the per-video JSON files
+def iter_transcript_files(transcripts_dir, video_ids):
+    for video_id in video_ids:
+        with open(os.path.join(transcripts_dir, f"{video_id}_transcript.json"), 'r') as file:
+            yield video_id, json.load(file)
+
+
+def build_corpus(transcripts_dir=transcripts_dir, corpus_dir=corpus_dir, batch_size=250):
+    """Pack transcript files that are not yet in the corpus, committing every `batch_size` videos"""
+    manifest = load_manifest(corpus_dir)
+    known = load_video_index(corpus_dir, manifest) if os.path.isdir(corpus_dir) else {}
+    suffix = '_transcript.json'
+    new_ids = sorted(name[:-len(suffix)] for name in os.listdir(transcripts_dir)
+                     if name.endswith(suffix) and name[:-len(suffix)] not in known)
+    appended = 0
+    for i in range(0, len(new_ids), batch_size):
+        batch = new_ids[i:i + batch_size]
+        appended += append_transcripts(corpus_dir, iter_transcript_files(transcripts_dir, batch))
+    return appended
+
+
+class TranscriptCorpus:
+    """Read-only, memory-mapped view of a packed corpus.
+
+    Text is returned as zero-copy memoryview slices of text.bin (or decoded
+    str via `text`), and segment times as read-only numpy views.
+    """
+
+    def __init__(self, corpus_dir=corpus_dir):
+        self.corpus_dir = corpus_dir
+        manifest = load_manifest(corpus_dir)
+        self.manifest = manifest
+        self.index = load_video_index(corpus_dir, manifest)
+        self.video_ids = list(self.index)
+        n_segments = manifest['n_segments']
+        self.offsets = map_array(os.path.join(corpus_dir, OFFSETS_FILE), OFFSET_DTYPE, (n_segments,))
+        self.starts = map_array(os.path.join(corpus_dir, STARTS_FILE), TIME_DTYPE, (n_segments,))
+        self.durations = map_array(os.path.join(corpus_dir, DURATIONS_FILE), TIME_DTYPE, (n_segments,))
+        self._text = memoryview(map_array(os.path.join(corpus_dir, TEXT_FILE), np.uint8, (manifest['text_bytes'],)))
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def __contains__(self, video_id):
+        return video_id in self.index
+
+    def _segment_end_offset(self, segment):
+        # Offset just past a segment's text, excluding its '\n' separator
+        if segment + 1 < len(self.offsets):
+            return int(self.offsets[segment + 1]) - 1
+        return self.manifest['text_bytes'] - 1
+
+    def segment_range(self, video_id):
+        first, count = self.index[video_id]
+        return first, first + count
+
+    def raw_text(self, video_id):
+        """The video's UTF-8 text, segments separated by '\\n', without copying"""
+        first, end = self.segment_range(video_id)
+        if first == end:
+            return self._text[0:0]
+        return self._text[int(self.offsets[first]):self._segment_end_offset(end - 1)]
+
+    def text(self, video_id):
+        return str(self.raw_text(video_id), 'utf-8')
+
+    def segments(self, video_id):
+        """Start times and durations of the video's segments, as read-only views"""
+        first, end = self.segment_range(video_id)
+        return self.starts[first:end], self.durations[first:end]
+
+    def segment_text(self, segment):
+        return str(self._text[int(self.offsets[segment]):self._segment_end_offset(segment)], 'utf-8')
+
+    def window(self, video_id, start, end):
+        """Text of the segments overlapping the time window [start, end) in seconds"""
+        first, _ = self.segment_range(video_id)
+        starts, durations = self.segments(video_id)
+        hits = np.flatnonzero((starts < end) & (starts + durations > start))
+        return '\n'.join(self.segment_text(first + int(i)) for i in hits)
+
+    def iter_texts(self):
+        for video_id in self.video_ids:
+            yield video_id, self.text(video_id)
+
+    def close(self):
+        # The maps are unmapped once the last view into them is released
+        self._text = None
+        self.offsets = self.starts = self.durations = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack data/transcripts into a memory-mapped corpus.")
+    parser.add_argument('--transcripts-dir', default=transcripts_dir)
+    parser.add_argument('--corpus-dir', default=corpus_dir)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    appended = build_corpus(args.transcripts_dir, args.corpus_dir)
+    print(f"Appended {appended} transcripts in {time.perf_counter() - start_time:.2f}s.")
+
+    start_time = time.perf_counter()
+    with TranscriptCorpus(args.corpus_dir) as corpus:
+        elapsed = time.perf_counter() - start_time
+        print(f"Opened corpus of {len(corpus)} videos, {corpus.manifest['n_segments']} segments and "
+              f"{corpus.manifest['text_bytes'] / 1e6:.1f} MB of text in {elapsed * 1000:.1f} ms.")
+
+
+if __name__ == '__main__':
+    main()
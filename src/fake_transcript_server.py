@@ -0,0 +1,188 @@
+"""Local stand-in for the YouTube transcript endpoint.
+
+Serves deterministic fake transcripts over HTTP with configurable latency,
+missing-transcript ratio, random server errors and a server-side rate limit
+that answers 429 when exceeded. Run this file directly to benchmark the
+concurrent fetcher in 03-data_get_transcripts offline.
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from youtube_transcript_api._errors import NoTranscriptFound, TooManyRequests
+from pipeline_state import open_ledger
+
+
+# Function to decide deterministically whether a fake video has a transcript
+def has_transcript(video_id, missing_ratio):
+    digest = hashlib.sha256(video_id.encode()).digest()
+    return digest[0] / 256 >= missing_ratio
+
+
+# Function to build a fake transcript in the same shape as YouTubeTranscriptApi.get_transcript
+def fake_transcript(video_id, segments=200):
+    rng = random.Random(video_id)
+    words = ['album', 'track', 'production', 'vocals', 'flat', 'decent', 'strong', 'light', 'melody', 'beat']
+    transcript = []
+    start = 0.0
+    for _ in range(segments):
+        duration = round(rng.uniform(1.5, 6.0), 3)
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 10)))
+        transcript.append({'text': text, 'start': round(start, 3), 'duration': duration})
+        start += duration * 0.8
+    return transcript
+
+
+class FakeTranscriptServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.05, missing_ratio=0.1, error_rate=0.0, rate_limit=None):
+        super().__init__(address, FakeTranscriptHandler)
+        self.latency = latency
+        self.missing_ratio = missing_ratio
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.stats = {'requests': 0, 'served': 0, 'missing': 0, 'errors': 0, 'throttled': 0}
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def allow_request(self):
+        # Fixed one-second window, like a coarse upstream throttle
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            return self._window_count <= self.rate_limit
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class FakeTranscriptHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'transcript':
+            self.send_json(404, {'error': 'not found'})
+            return
+        video_id = parts[1]
+
+        if not server.allow_request():
+            server.count('throttled')
+            self.send_json(429, {'error': 'too many requests'})
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('errors')
+            self.send_json(500, {'error': 'internal error'})
+            return
+        if not has_transcript(video_id, server.missing_ratio):
+            server.count('missing')
+            self.send_json(404, {'error': 'no transcript'})
+            return
+        server.count('served')
+        self.send_json(200, fake_transcript(video_id))
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to start a fake server on a background thread
+def start_server(host='127.0.0.1', port=0, **options):
+    server = FakeTranscriptServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# Function to build a drop-in replacement for YouTubeTranscriptApi.get_transcript
+def make_fetcher(base_url, timeout=10):
+    session = requests.Session()
+
+    def fetch(video_id):
+        response = session.get(f"{base_url.rstrip('/')}/transcript/{video_id}", timeout=timeout)
+        if response.status_code == 404:
+            raise NoTranscriptFound(video_id, ['en'], None)
+        if response.status_code == 429:
+            raise TooManyRequests(video_id)
+        response.raise_for_status()
+        return response.json()
+
+    return fetch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the concurrent transcript fetcher against a local fake server.")
+    parser.add_argument('--videos', type=int, default=500)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--rps', type=float, default=0, help="client-side rate limit (0 for none)")
+    parser.add_argument('--latency', type=float, default=0.05, help="server latency per request in seconds")
+    parser.add_argument('--missing-ratio', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--server-rate-limit', type=int, default=None,
+                        help="requests per second the server accepts before answering 429")
+    parser.add_argument('--serve', action='store_true', help="only run the server until interrupted")
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    server = start_server(port=args.port, latency=args.latency, missing_ratio=args.missing_ratio,
+                          error_rate=args.error_rate, rate_limit=args.server_rate_limit)
+    if args.serve:
+        print(f"Fake transcript server listening on {server.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    transcripts = importlib.import_module('03-data_get_transcripts')
+    fetch = make_fetcher(server.url)
+    video_ids = [f"fake{i:07d}" for i in range(args.videos)]
+    print(f"{'workers':>8} {'seconds':>8} {'videos/s':>9} {'fetched':>8} {'missing':>8} {'failed':>7} {'retries':>8} {'429s':>6}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server.stats = dict.fromkeys(server.stats, 0)
+            ledger = open_ledger(f"{tmp_dir}/pipeline_state.sqlite")
+            # Silence the per-video progress lines so only the summary table is printed
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = transcripts.fetch_transcripts(video_ids, tmp_dir, ledger, workers, args.rps,
+                                                      fetch=fetch)
+            ledger.close()
+            rate = len(video_ids) / stats['elapsed']
+            print(f"{workers:>8} {stats['elapsed']:>8.2f} {rate:>9.1f} {stats['fetched']:>8} "
+                  f"{stats['unavailable']:>8} {stats['failed']:>7} {stats['retries']:>8} {server.stats['throttled']:>6}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""On-disk cache of API responses shared by the YouTube and Spotify clients.
+
+Successful GET responses are stored content-addressed under
+data/cache/http/objects (zlib-compressed, named by the SHA-256 of the body,
+so identical bodies are kept once) and indexed in a small SQLite database
+keyed by a hash of the method and URL. API keys are left out of the key.
+
+Entries expire after a per-endpoint TTL (see `DEFAULT_TTLS`), and the least
+recently used ones are evicted once the stored bodies exceed `max_bytes`.
+In offline mode expired entries are served too and misses raise
+`OfflineCacheMiss` instead of reaching the network, so a failed run can be
+replayed without spending quota.
+
+Route the clients through the cache with:
+
+    build('youtube', 'v3', developerKey=..., http=CachedHttp(cache))
+    spotipy.Spotify(auth_manager=..., requests_session=CachedSession(cache))
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests
+from instrumentation import span, count
+
+CACHE_DIR = 'data/cache/http'
+MAX_BYTES = 256 * 1024 * 1024
+
+DAY = 24 * 60 * 60
+# (URL substring, seconds) pairs, first match wins; a TTL of 0 disables caching
+DEFAULT_TTLS = [
+    # New uploads appear at the head of the uploads playlist
+    ('youtube/v3/playlistItems', 60 * 60),
+    ('youtube/v3/videos', 7 * DAY),
+    ('api.spotify.com/v1/search', 30 * DAY),
+    ('api.spotify.com/v1/albums', 30 * DAY),
+    ('api.spotify.com/v1/artists', 30 * DAY),
+    ('api.spotify.com/v1/audio-features', 30 * DAY),
+]
+DEFAULT_TTL = DAY
+
+# Query parameters that identify the caller rather than the resource
+SECRET_PARAMS = {'key', 'access_token'}
+# Headers that describe the original transfer rather than the stored body
+TRANSFER_HEADERS = {'status', 'set-cookie', 'content-length', 'content-encoding', '-content-encoding',
+                    'transfer-encoding'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    url TEXT,
+    status INTEGER,
+    headers TEXT,
+    body_hash TEXT,
+    stored_at REAL,
+    last_used REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_body_hash ON entries (body_hash);
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER
+) WITHOUT ROWID;
+"""
+
+
+class OfflineCacheMiss(requests.exceptions.ConnectionError):
+    """Raised in offline mode for a request that has no cached response"""
+
+
+def storable_headers(headers):
+    return {name: value for name, value in headers if name.lower() not in TRANSFER_HEADERS}
+
+# Function to drop credentials from a URL and sort its query, so equivalent requests share a key
+def normalize_url(url):
+    parts = urlsplit(url)
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if name not in SECRET_PARAMS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+class ResponseCache:
+    """Size-bounded LRU store of HTTP responses with per-endpoint TTLs; safe to share between threads"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, ttls=DEFAULT_TTLS, default_ttl=DEFAULT_TTL,
+                 offline=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.offline = offline
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def ttl(self, url):
+        for pattern, seconds in self.ttls:
+            if pattern in url:
+                return seconds
+        return self.default_ttl
+
+    def key(self, method, url):
+        return hashlib.sha256(f"{method.upper()} {normalize_url(url)}".encode()).hexdigest()
+
+    def _object_path(self, body_hash):
+        return os.path.join(self.cache_dir, 'objects', body_hash[:2], body_hash)
+
+    def get(self, method, url):
+        """The cached (status, headers, body) for a request, or None"""
+        ttl = self.ttl(url)
+        if method.upper() != 'GET' or (not ttl and not self.offline):
+            return None
+        key = self.key(method, url)
+        with self._lock, span('io.http_cache.get'):
+            row = self._conn.execute("SELECT status, headers, body_hash, stored_at FROM entries WHERE key = ?",
+                                     (key,)).fetchone()
+            fresh = row is not None and (self.offline or time.time() - row[3] < ttl)
+            if fresh:
+                try:
+                    with open(self._object_path(row[2]), 'rb') as file:
+                        body = zlib.decompress(file.read())
+                except (OSError, zlib.error):
+                    fresh = False
+            if not fresh:
+                self.stats['misses'] += 1
+                count('http_cache.misses')
+                if self.offline:
+                    raise OfflineCacheMiss(f"No cached response for {method} {normalize_url(url)}")
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += len(body)
+            count('http_cache.hits')
+            count('http_cache.bytes_saved', len(body))
+            return row[0], json.loads(row[1]), body
+
+    def put(self, method, url, status, headers, body):
+        if method.upper() != 'GET' or status != 200 or not self.ttl(url) or self.offline:
+            return
+        key = self.key(method, url)
+        body_hash = hashlib.sha256(body).hexdigest()
+        path = self._object_path(body_hash)
+        now = time.time()
+        with self._lock, span('io.http_cache.put'):
+            if not self._conn.execute("SELECT 1 FROM objects WHERE hash = ?", (body_hash,)).fetchone():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = zlib.compress(body, 1)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'wb') as file:
+                    file.write(data)
+                os.replace(tmp_path, path)
+                with self._conn:
+                    self._conn.execute("INSERT INTO objects (hash, size) VALUES (?, ?)", (body_hash, len(data)))
+                self._total_bytes += len(data)
+                count('bytes.written', len(data))
+            old = self._conn.execute("SELECT body_hash FROM entries WHERE key = ?", (key,)).fetchone()
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO entries (key, url, status, headers, body_hash, stored_at, last_used) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (key, normalize_url(url), status, json.dumps(dict(headers)), body_hash, now, now))
+            if old and old[0] != body_hash:
+                self._drop_unreferenced(old[0])
+            self.stats['stores'] += 1
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _drop_unreferenced(self, body_hash):
+        if self._conn.execute("SELECT 1 FROM entries WHERE body_hash = ? LIMIT 1", (body_hash,)).fetchone():
+            return
+        row = self._conn.execute("SELECT size FROM objects WHERE hash = ?", (body_hash,)).fetchone()
+        with self._conn:
+            self._conn.execute("DELETE FROM objects WHERE hash = ?", (body_hash,))
+        if row:
+            self._total_bytes -= row[0]
+        try:
+            os.remove(self._object_path(body_hash))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Evict down to 90% of the bound so a full cache does not evict on every store
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, body_hash FROM entries ORDER BY last_used").fetchall()
+        for key, body_hash in rows:
+            if self._total_bytes <= target:
+                break
+            with self._conn:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._drop_unreferenced(body_hash)
+            self.stats['evictions'] += 1
+            count('http_cache.evictions')
+
+    def report(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups * 100 if lookups else 0.0
+        mode = ' (offline)' if self.offline else ''
+        return (f"HTTP cache{mode}: {self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.0f}% hit rate), "
+                f"{self.stats['bytes_saved'] / 1e6:.2f} MB not downloaded, {self.stats['stores']} stored, "
+                f"{self.stats['evictions']} evicted; {self._total_bytes / 1e6:.1f} MB on disk.")
+
+    def close(self):
+        self._conn.close()
+
+
+class CachedHttp:
+    """httplib2.Http look-alike that answers from a ResponseCache, for googleapiclient's `build(http=...)`.
+
+    `from_cache` tells whether the last request on the current thread was
+    served from the cache, e.g. so quota is only charged for real calls.
+    """
+
+    def __init__(self, cache, http=None):
+        import httplib2
+        self._httplib2 = httplib2
+        self.cache = cache
+        self.http = http or httplib2.Http()
+        self._local = threading.local()
+
+    @property
+    def from_cache(self):
+        return getattr(self._local, 'from_cache', False)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        cached = self.cache.get(method, uri) if body is None else None
+        self._local.from_cache = cached is not None
+        if cached is not None:
+            status, cached_headers, content = cached
+            return self._httplib2.Response({**cached_headers, 'status': str(status)}), content
+        response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        if body is None:
+            self.cache.put(method, uri, response.status, storable_headers(response.items()), content)
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class CachedSession(requests.Session):
+    """requests.Session that answers GETs from a ResponseCache, for `spotipy.Spotify(requests_session=...)`"""
+
+    def __init__(self, cache, max_retries=None):
+        super().__init__()
+        self.cache = cache
+        if max_retries is not None:
+            adapter = requests.adapters.HTTPAdapter(max_retries=max_retries)
+            self.mount('http://', adapter)
+            self.mount('https://', adapter)
+
+    def request(self, method, url, params=None, data=None, json=None, **kwargs):
+        cacheable = method.upper() == 'GET' and data is None and json is None
+        if not cacheable:
+            return super().request(method, url, params=params, data=data, json=json, **kwargs)
+        full_url = requests.Request(method, url, params=params).prepare().url
+        cached = self.cache.get(method, full_url)
+        if cached is not None:
+            status, headers, body = cached
+            response = requests.Response()
+            response.status_code = status
+            response.headers = requests.structures.CaseInsensitiveDict(headers)
+            response._content = body
+            response.url = full_url
+            response.reason = 'OK'
+            response.encoding = 'utf-8'
+            return response
+        response = super().request(method, url, params=params, **kwargs)
+        self.cache.put(method, full_url, response.status_code, storable_headers(response.headers.items()),
+                       response.content)
+        return response
@@ -0,0 +1,385 @@
+"""Run metrics for the pipeline stages.
+
+A stage calls `start_run` once at the top of its main function. Code anywhere
+in the process then records into that run through the module-level helpers:
+
+    with span('api.videos.list'):        # timed section, aggregated by name
+        response = request.execute()
+    count('bytes.written', len(data))    # counter
+    progress = progress_bar('videos', total=len(video_ids))
+    progress.update(fetched=1)           # rate-limited progress line
+
+Span names start with their kind (api., io., parse., ...) so a report shows
+at a glance whether time goes to the network, the disk or the CPU.
+
+Each run writes one NDJSON log, data/logs/<stage>/<run id>.ndjson, holding a
+start record, progress and event records, and a closing summary with span
+statistics, counters, wall and CPU time and peak memory. The summary is
+printed when the process exits. Setting PIPELINE_PROFILE=cpu (cProfile) or
+PIPELINE_PROFILE=memory (tracemalloc) adds the top functions or allocation
+sites to the summary; 00-main sets it with --profile.
+
+Compare the last two runs of a stage with:
+
+    python src/instrumentation.py compare 03
+
+Without a started run the helpers record into a run that is never written,
+so library modules can be instrumented unconditionally. Spans and counters
+are thread-safe but stay in the process that records them.
+"""
+import argparse
+import atexit
+import cProfile
+import datetime
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+LOG_DIR = 'data/logs'
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILES = ('cpu', 'memory')
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 5.0
+# Functions or allocation sites kept in a profiled run's summary
+PROFILE_TOP = 15
+
+
+# Function to pick the value at quantile q from a sorted list
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def peak_rss_mb(children=False):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        # The largest single child that has been waited for, e.g. a pool worker
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class Progress:
+    """Counts items done and prints at most one progress line every `interval` seconds"""
+
+    def __init__(self, run, name, total=None, interval=PROGRESS_INTERVAL):
+        self.run = run
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.outcomes = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def update(self, amount=1, **outcomes):
+        """Add `amount` finished items, optionally broken down by outcome, e.g. update(fetched=1)"""
+        if outcomes:
+            amount = sum(outcomes.values())
+        with self._lock:
+            self.done += amount
+            for outcome, n in outcomes.items():
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+            now = time.perf_counter()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            line = self._line(now)
+        print(line, flush=True)
+
+    def _line(self, now):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed else 0.0
+        if self.total:
+            eta = (self.total - self.done) / rate if rate else 0.0
+            line = (f"{self.name}: {self.done}/{self.total} ({self.done / self.total * 100:.0f}%), "
+                    f"{rate:.1f}/s, ETA {format_duration(eta)}")
+        else:
+            line = f"{self.name}: {self.done} done, {rate:.1f}/s"
+        if self.outcomes:
+            line += ' [' + ', '.join(f"{outcome} {n}" for outcome, n in sorted(self.outcomes.items())) + ']'
+        self.run.write({'type': 'progress', 'name': self.name, 'done': self.done, 'total': self.total,
+                        'outcomes': dict(self.outcomes), 'elapsed': round(elapsed, 3)})
+        return line
+
+    def close(self):
+        """Print the final count, whatever the interval"""
+        with self._lock:
+            line = self._line(time.perf_counter())
+        print(line, flush=True)
+
+
+class Run:
+    """Spans, counters and events of one stage run, written to an NDJSON log unless `stage` is None"""
+
+    def __init__(self, stage=None, log_dir=LOG_DIR, profile=None):
+        if profile not in (None, '') + PROFILES:
+            raise ValueError(f"Unknown profile mode {profile!r}; expected one of {', '.join(PROFILES)}")
+        self.stage = stage
+        self.profile = profile or None
+        self.status = 'ok'
+        self.spans = {}
+        self.counters = {}
+        self.run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        self.path = None
+        self._file = None
+        self._finished = False
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        if stage is not None:
+            directory = os.path.join(log_dir, stage)
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, f"{self.run_id}.ndjson")
+            self._file = open(self.path, 'a', buffering=1)
+            self.write({'type': 'start', 'stage': stage, 'run_id': self.run_id, 'argv': sys.argv,
+                        'pid': os.getpid(), 'profile': self.profile})
+        self._profiler = None
+        if self.profile == 'cpu':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == 'memory':
+            tracemalloc.start()
+
+    def write(self, record):
+        if self._file is None:
+            return
+        record = {'time': round(time.time(), 3), **record}
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.spans.setdefault(name, []).append(elapsed)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def event(self, kind, **fields):
+        """Log a notable occurrence, e.g. a skipped item, without printing it"""
+        self.count(f"events.{kind}")
+        self.write({'type': 'event', 'kind': kind, **fields})
+
+    def progress(self, name, total=None, interval=PROGRESS_INTERVAL):
+        return Progress(self, name, total, interval)
+
+    def summary(self):
+        wall = time.perf_counter() - self._start
+        spans = {}
+        with self._lock:
+            for name, durations in self.spans.items():
+                durations = sorted(durations)
+                total = sum(durations)
+                spans[name] = {'count': len(durations), 'total': round(total, 6),
+                               'mean': round(total / len(durations), 6), 'p50': round(percentile(durations, 0.5), 6),
+                               'p95': round(percentile(durations, 0.95), 6), 'max': round(durations[-1], 6)}
+            counters = dict(self.counters)
+        return {'type': 'summary', 'stage': self.stage, 'run_id': self.run_id, 'status': self.status,
+                'wall_seconds': round(wall, 3), 'cpu_seconds': round(time.process_time() - self._cpu_start, 3),
+                'peak_rss_mb': round(peak_rss_mb(), 1), 'spans': spans, 'counters': counters}
+
+    def _profile_summary(self):
+        if self.profile == 'cpu':
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler, stream=io.StringIO())
+            if self.path:
+                stats.dump_stats(self.path.replace('.ndjson', '.prof'))
+            top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+            return [{'function': f"{os.path.basename(file)}:{line}({function})", 'calls': calls,
+                     'own': round(own, 6), 'cumulative': round(cumulative, 6)}
+                    for (file, line, function), (_, calls, own, cumulative, _) in top]
+        if self.profile == 'memory':
+            # Leave out the allocations made by the measuring itself
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                                  tracemalloc.Filter(False, tracemalloc.__file__)])
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            top = snapshot.statistics('lineno')[:PROFILE_TOP]
+            return [{'site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                     'mb': round(stat.size / 1e6, 3), 'blocks': stat.count} for stat in top] + \
+                   [{'site': 'peak traced', 'mb': round(peak / 1e6, 3), 'blocks': None}]
+        return None
+
+    def finish(self):
+        """Write the summary record and print the report; later calls do nothing"""
+        if self._finished:
+            return None
+        self._finished = True
+        summary = self.summary()
+        profile = self._profile_summary()
+        if profile is not None:
+            summary['profile'] = {'mode': self.profile, 'top': profile}
+        if self._file is not None:
+            self.write(summary)
+            self._file.close()
+            print(format_report(summary, self.path), flush=True)
+        return summary
+
+
+# Function to render a summary record as a table of spans and counters
+def format_report(summary, path=None):
+    where = f" ({path})" if path else ''
+    lines = [f"Run metrics for {summary['stage']}{where}: {summary['status']}, {summary['wall_seconds']:.1f}s wall, "
+             f"{summary['cpu_seconds']:.1f}s CPU, {summary['peak_rss_mb']:.0f} MB peak"]
+    if summary['spans']:
+        lines.append(f"  {'span':<32} {'count':>7} {'total s':>9} {'% wall':>7} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        wall = summary['wall_seconds'] or 1.0
+        for name, span in sorted(summary['spans'].items(), key=lambda item: item[1]['total'], reverse=True):
+            lines.append(f"  {name:<32} {span['count']:>7} {span['total']:>9.2f} {span['total'] / wall * 100:>6.0f}% "
+                         f"{span['mean'] * 1000:>9.1f} {span['p95'] * 1000:>9.1f} {span['max'] * 1000:>9.1f}")
+    if summary['counters']:
+        lines.append('  ' + ', '.join(f"{name} {format_number(value)}" for name, value in sorted(summary['counters'].items())))
+    profile = summary.get('profile')
+    if profile and profile['mode'] == 'cpu':
+        lines.append(f"  {'function (cProfile)':<60} {'calls':>9} {'own s':>8} {'cum s':>8}")
+        lines.extend(f"  {entry['function'][:60]:<60} {entry['calls']:>9} {entry['own']:>8.2f} {entry['cumulative']:>8.2f}"
+                     for entry in profile['top'])
+    elif profile:
+        lines.append(f"  {'allocation site (tracemalloc)':<60} {'MB':>9}")
+        lines.extend(f"  {entry['site'][:60]:<60} {entry['mb']:>9.2f}" for entry in profile['top'])
+    return '\n'.join(lines)
+
+def format_number(value):
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+
+# The run the module-level helpers record into
+_run = Run()
+
+def _mark_failed(previous_hook):
+    def hook(*exc_info):
+        _run.status = 'failed'
+        previous_hook(*exc_info)
+    return hook
+
+def start_run(stage, profile=None, log_dir=LOG_DIR):
+    """Start recording this process's metrics for `stage`; the summary is written at exit"""
+    global _run
+    _run = Run(stage, log_dir, profile or os.environ.get(PROFILE_ENV))
+    atexit.register(_run.finish)
+    sys.excepthook = _mark_failed(sys.excepthook)
+    return _run
+
+def current_run():
+    return _run
+
+def span(name):
+    return _run.span(name)
+
+def count(name, amount=1):
+    _run.count(name, amount)
+
+def event(kind, **fields):
+    _run.event(kind, **fields)
+
+def progress_bar(name, total=None, interval=PROGRESS_INTERVAL):
+    return _run.progress(name, total, interval)
+
+
+# Function to read the summary record of every finished run of a stage, oldest first
+def load_summaries(stage, log_dir=LOG_DIR):
+    directory = os.path.join(log_dir, stage)
+    summaries = []
+    if not os.path.isdir(directory):
+        return summaries
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.ndjson'):
+            continue
+        with open(os.path.join(directory, name), 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A run killed mid-write
+                if record.get('type') == 'summary':
+                    summaries.append(record)
+    return summaries
+
+def latest_summary(stage, log_dir=LOG_DIR):
+    """The summary record of the newest run log of a stage, or None when that run has not finished"""
+    directory = os.path.join(log_dir, stage)
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.ndjson')) if os.path.isdir(directory) else []
+    if not names:
+        return None
+    with open(os.path.join(directory, names[-1]), 'rb') as file:
+        # The summary is the last line; read only the end of the file
+        file.seek(max(0, os.path.getsize(file.name) - (1 << 20)))
+        lines = file.read().splitlines()
+    try:
+        record = json.loads(lines[-1]) if lines else None
+    except json.JSONDecodeError:
+        return None
+    return record if record and record.get('type') == 'summary' else None
+
+def change(before, after):
+    if not before:
+        return 'new' if after else ''
+    return f"{(after - before) / before * 100:+.0f}%"
+
+def compare_runs(baseline, current):
+    """Table of span totals and counters of two summary records, largest spans first"""
+    lines = [f"{current['stage']}: run {baseline['run_id']} -> {current['run_id']}",
+             f"  {'':<32} {'before':>10} {'after':>10} {'change':>8}",
+             f"  {'wall seconds':<32} {baseline['wall_seconds']:>10.2f} {current['wall_seconds']:>10.2f} "
+             f"{change(baseline['wall_seconds'], current['wall_seconds']):>8}",
+             f"  {'cpu seconds':<32} {baseline['cpu_seconds']:>10.2f} {current['cpu_seconds']:>10.2f} "
+             f"{change(baseline['cpu_seconds'], current['cpu_seconds']):>8}",
+             f"  {'peak MB':<32} {baseline['peak_rss_mb']:>10.0f} {current['peak_rss_mb']:>10.0f} "
+             f"{change(baseline['peak_rss_mb'], current['peak_rss_mb']):>8}"]
+    names = sorted(set(baseline['spans']) | set(current['spans']),
+                   key=lambda name: current['spans'].get(name, {}).get('total', 0), reverse=True)
+    for name in names:
+        before = baseline['spans'].get(name, {}).get('total', 0.0)
+        after = current['spans'].get(name, {}).get('total', 0.0)
+        lines.append(f"  {name + ' (s)':<32} {before:>10.2f} {after:>10.2f} {change(before, after):>8}")
+    for name in sorted(set(baseline['counters']) | set(current['counters'])):
+        before = baseline['counters'].get(name, 0)
+        after = current['counters'].get(name, 0)
+        lines.append(f"  {name:<32} {format_number(before):>10} {format_number(after):>10} {change(before, after):>8}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show and compare the metrics of pipeline runs.")
+    parser.add_argument('command', choices=['report', 'compare'],
+                        help="report: the latest run; compare: the latest run against an earlier one")
+    parser.add_argument('stage', help="stage whose runs to read, e.g. 03")
+    parser.add_argument('--back', type=int, default=1, help="compare against the run this many runs earlier")
+    parser.add_argument('--log-dir', default=LOG_DIR)
+    args = parser.parse_args()
+
+    summaries = load_summaries(args.stage, args.log_dir)
+    if not summaries:
+        sys.exit(f"No finished runs of stage {args.stage} in {args.log_dir}")
+    if args.command == 'report':
+        print(format_report(summaries[-1]))
+    elif len(summaries) <= args.back:
+        sys.exit(f"Only {len(summaries)} finished runs of stage {args.stage}")
+    else:
+        print(compare_runs(summaries[-1 - args.back], summaries[-1]))
+
+if __name__ == '__main__':
+    main()
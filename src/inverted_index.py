@@ -0,0 +1,380 @@
+"""Positional inverted index over the packed transcript corpus.
+
+Each build indexes the corpus videos not indexed yet into shards of up to
+`max_shard_videos` videos under data/index. A last shard with room left is
+rebuilt together with the new videos rather than followed by a small one, so
+the number of shards, and with it open and query cost, grows with the corpus
+and not with the number of runs. Shards are written once into a fresh
+directory; manifest.json lists the committed shards and is replaced
+atomically after a shard is written. A shard holds:
+
+    terms.txt              its vocabulary, sorted, one term per line
+    term_offsets.i64       byte offset of each term's postings in postings.bin (+ end)
+    term_df.i32            number of videos containing each term
+    term_cf.i32            number of occurrences of each term
+    postings.bin           per term: video gaps, then frequencies, then position gaps, all varints
+    docs.ndjson            one {"video_id", "first_segment", "n_segments", "n_tokens"} line per video
+    segment_tokens.i64     shard-wide token position where each of its segments starts
+
+Positions count tokens from the start of a video, so phrases may span
+segments; an occurrence is mapped back to its segment, and so to the
+segment's start time in the corpus, through segment_tokens.i64. Arrays are
+memory-mapped and postings are decoded with vectorized numpy, so term,
+phrase and co-occurrence lookups take milliseconds and never scan the text.
+
+00-main brings the index up to date as stage 09, after 03 has packed new
+transcripts into the corpus; running this module without queries does the
+same. With queries it indexes anything new and then answers them.
+"""
+import argparse
+import json
+import os
+import re
+import time
+import shutil
+from collections import defaultdict
+import numpy as np
+from corpus_store import TranscriptCorpus
+from video_records import load_scores
+from store_files import load_json, save_json, map_array
+from instrumentation import start_run, count
+
+index_dir = 'data/index'
+corpus_dir = 'data/corpus'
+
+MANIFEST_FILE = 'manifest.json'
+TERMS_FILE = 'terms.txt'
+TERM_OFFSETS_FILE = 'term_offsets.i64'
+TERM_DF_FILE = 'term_df.i32'
+TERM_CF_FILE = 'term_cf.i32'
+POSTINGS_FILE = 'postings.bin'
+DOCS_FILE = 'docs.ndjson'
+SEGMENT_TOKENS_FILE = 'segment_tokens.i64'
+
+token_pattern = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+# Keys that pack a global video number and a token position into one sortable integer
+POSITION_BITS = 32
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+# Function to encode non-negative integers as LEB128 varints, 7 bits per byte
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max()) if len(values) else 0):
+        has_byte = n_bytes > k
+        chunk = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (n_bytes[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + k] = (chunk | more).astype(np.uint8)
+    return out, n_bytes
+
+def decode_varints(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.int64)
+    last = data < 0x80
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # Position of every byte within its varint
+    shift = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    contributions = (data & 0x7F).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(contributions, starts)
+
+
+def load_manifest(index_dir):
+    return load_json(os.path.join(index_dir, MANIFEST_FILE), {'version': 1, 'shards': []})
+
+def save_manifest(manifest, index_dir):
+    save_json(manifest, os.path.join(index_dir, MANIFEST_FILE))
+
+
+def write_shard(shard_dir, corpus, video_ids):
+    """Index `video_ids` from the corpus into a new shard directory"""
+    os.makedirs(shard_dir, exist_ok=True)
+    postings = defaultdict(list)
+    docs = []
+    segment_tokens = []
+    token_base = 0
+    for doc, video_id in enumerate(video_ids):
+        first_segment, end_segment = corpus.segment_range(video_id)
+        tokens = []
+        # Segment texts may contain newlines themselves, so walk the segments rather than split the text
+        for segment in range(first_segment, end_segment):
+            segment_tokens.append(token_base + len(tokens))
+            tokens.extend(tokenize(corpus.segment_text(segment)))
+        positions = defaultdict(list)
+        for position, token in enumerate(tokens):
+            positions[token].append(position)
+        for term, term_positions in positions.items():
+            postings[term].append((doc, term_positions))
+        docs.append({'video_id': video_id, 'first_segment': first_segment,
+                     'n_segments': end_segment - first_segment, 'n_tokens': len(tokens)})
+        token_base += len(tokens)
+
+    terms = sorted(postings)
+    values = []
+    value_counts = []
+    df = []
+    cf = []
+    for term in terms:
+        entries = postings[term]
+        previous = 0
+        doc_gaps, frequencies, position_gaps = [], [], []
+        for doc, term_positions in entries:
+            doc_gaps.append(doc - previous)
+            previous = doc
+            frequencies.append(len(term_positions))
+            position_gaps.append(term_positions[0])
+            position_gaps.extend(b - a for a, b in zip(term_positions, term_positions[1:]))
+        block = doc_gaps + frequencies + position_gaps
+        values.extend(block)
+        value_counts.append(len(block))
+        df.append(len(entries))
+        cf.append(len(position_gaps))
+
+    data, n_bytes = encode_varints(values)
+    # Byte offset of each term's block, from the byte lengths of the values before it
+    value_ends = np.cumsum(value_counts)
+    byte_ends = np.cumsum(n_bytes)
+    offsets = np.concatenate(([0], byte_ends[value_ends - 1] if len(terms) else [])).astype('<i8')
+
+    data.tofile(os.path.join(shard_dir, POSTINGS_FILE))
+    offsets.tofile(os.path.join(shard_dir, TERM_OFFSETS_FILE))
+    np.asarray(df, dtype='<i4').tofile(os.path.join(shard_dir, TERM_DF_FILE))
+    np.asarray(cf, dtype='<i4').tofile(os.path.join(shard_dir, TERM_CF_FILE))
+    with open(os.path.join(shard_dir, TERMS_FILE), 'w') as file:
+        file.write(''.join(f"{term}\n" for term in terms))
+    with open(os.path.join(shard_dir, DOCS_FILE), 'w') as file:
+        file.write(''.join(json.dumps(doc) + '\n' for doc in docs))
+    np.asarray(segment_tokens, dtype='<i8').tofile(os.path.join(shard_dir, SEGMENT_TOKENS_FILE))
+    return len(docs)
+
+
+# Function to read the IDs of the videos in a committed shard, in shard order
+def shard_video_ids(index_dir, shard):
+    with open(os.path.join(index_dir, shard['dir'], DOCS_FILE), 'r') as file:
+        return [json.loads(line)['video_id'] for line in file]
+
+def update_index(corpus, index_dir=index_dir, max_shard_videos=5000):
+    """Index the corpus videos that no committed shard covers yet. Returns the number indexed."""
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = load_manifest(index_dir)
+    indexed = set()
+    for shard in manifest['shards']:
+        indexed.update(shard_video_ids(index_dir, shard))
+    new_ids = [video_id for video_id in corpus.video_ids if video_id not in indexed]
+    if not new_ids:
+        return 0
+
+    # Refill the last shard while it has room instead of adding a small one after it
+    replaced = None
+    video_ids = new_ids
+    if manifest['shards'] and manifest['shards'][-1]['n_docs'] < max_shard_videos:
+        replaced = manifest['shards'].pop()
+        video_ids = shard_video_ids(index_dir, replaced) + new_ids
+    for i in range(0, len(video_ids), max_shard_videos):
+        # Never reuse a committed directory, as readers may have its files mapped
+        next_shard = manifest.get('next_shard', len(manifest['shards']) + (replaced is not None))
+        shard = f"shard_{next_shard:05d}"
+        n_docs = write_shard(os.path.join(index_dir, shard), corpus, video_ids[i:i + max_shard_videos])
+        manifest['shards'].append({'dir': shard, 'n_docs': n_docs})
+        manifest['next_shard'] = next_shard + 1
+        save_manifest(manifest, index_dir)
+        if replaced is not None:
+            shutil.rmtree(os.path.join(index_dir, replaced['dir']))
+            replaced = None
+    return len(new_ids)
+
+
+class Shard:
+    def __init__(self, shard_dir, doc_base):
+        self.doc_base = doc_base
+        with open(os.path.join(shard_dir, TERMS_FILE), 'r') as file:
+            self.term_ids = {line.rstrip('\n'): i for i, line in enumerate(file)}
+        self.offsets = map_array(os.path.join(shard_dir, TERM_OFFSETS_FILE), '<i8')
+        self.df = map_array(os.path.join(shard_dir, TERM_DF_FILE), '<i4')
+        self.cf = map_array(os.path.join(shard_dir, TERM_CF_FILE), '<i4')
+        self.postings = map_array(os.path.join(shard_dir, POSTINGS_FILE), np.uint8)
+        self.segment_tokens = map_array(os.path.join(shard_dir, SEGMENT_TOKENS_FILE), '<i8')
+        with open(os.path.join(shard_dir, DOCS_FILE), 'r') as file:
+            self.docs = [json.loads(line) for line in file]
+        counts = np.array([doc['n_segments'] for doc in self.docs], dtype=np.int64)
+        tokens = np.array([doc['n_tokens'] for doc in self.docs], dtype=np.int64)
+        # Shard-wide first segment and first token of each video, and its first segment in the corpus
+        self.segment_base = np.cumsum(counts) - counts
+        self.token_base = np.cumsum(tokens) - tokens
+        self.corpus_segment = np.array([doc['first_segment'] for doc in self.docs], dtype=np.int64)
+
+    def lookup(self, term):
+        """Global video numbers, per-video frequencies and positions of a term, or None"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return None
+        df, cf = int(self.df[term_id]), int(self.cf[term_id])
+        values = decode_varints(self.postings[self.offsets[term_id]:self.offsets[term_id + 1]])
+        docs = np.cumsum(values[:df])
+        frequencies = values[df:2 * df]
+        # Position gaps restart at every video
+        positions = np.cumsum(values[2 * df:2 * df + cf])
+        doc_starts = np.cumsum(frequencies) - frequencies
+        positions -= np.repeat(np.concatenate(([0], positions[doc_starts[1:] - 1])), frequencies)
+        return docs + self.doc_base, frequencies, positions
+
+
+class InvertedIndex:
+    """Read-only view of every committed shard.
+
+    Videos are numbered globally in shard order; `video_ids[n]` is the ID of
+    video number n. Occurrences are handled as int64 keys packing the video
+    number and token position, so queries are sorted-array operations.
+    """
+
+    def __init__(self, index_dir=index_dir, corpus_dir=corpus_dir):
+        manifest = load_manifest(index_dir)
+        self.shards = []
+        self.video_ids = []
+        for entry in manifest['shards']:
+            shard = Shard(os.path.join(index_dir, entry['dir']), len(self.video_ids))
+            self.shards.append(shard)
+            self.video_ids.extend(doc['video_id'] for doc in shard.docs)
+        self.corpus = TranscriptCorpus(corpus_dir)
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def occurrences(self, term):
+        """Sorted keys of every occurrence of a single term"""
+        keys = []
+        for shard in self.shards:
+            found = shard.lookup(term)
+            if found is not None:
+                docs, frequencies, positions = found
+                keys.append((np.repeat(docs, frequencies) << POSITION_BITS) | positions)
+        return np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+
+    def phrase(self, phrase):
+        """Keys of the first token of every occurrence of a phrase (or single term)"""
+        terms = tokenize(phrase)
+        if not terms:
+            return np.empty(0, dtype=np.int64)
+        # Start from the rarest term, shifting each term's positions back to the phrase start
+        by_term = [(self.occurrences(term), offset) for offset, term in enumerate(terms)]
+        by_term.sort(key=lambda item: len(item[0]))
+        keys = None
+        for term_keys, offset in by_term:
+            shifted = term_keys - offset
+            # A shift must not move an occurrence into the previous video's key range
+            shifted = shifted[(term_keys & ((1 << POSITION_BITS) - 1)) >= offset]
+            keys = shifted if keys is None else np.intersect1d(keys, shifted, assume_unique=True)
+            if not len(keys):
+                break
+        return keys
+
+    def near(self, first, second, window=10):
+        """Keys of occurrences of `first` with an occurrence of `second` at most `window` tokens away"""
+        first_keys = self.phrase(first)
+        second_keys = self.phrase(second)
+        if not len(first_keys) or not len(second_keys):
+            return np.empty(0, dtype=np.int64)
+        # Nearest occurrence of `second` on either side; keys of different videos are 2^32 apart
+        i = np.searchsorted(second_keys, first_keys)
+        before = second_keys[np.maximum(i - 1, 0)]
+        after = second_keys[np.minimum(i, len(second_keys) - 1)]
+        distance = np.minimum(np.abs(first_keys - before), np.abs(after - first_keys))
+        return first_keys[distance <= window]
+
+    def videos(self, keys):
+        """IDs of the distinct videos among occurrence keys"""
+        return [self.video_ids[n] for n in np.unique(keys >> POSITION_BITS)]
+
+    def hits(self, keys, limit=None):
+        """(video ID, segment start time, segment text) for occurrence keys"""
+        keys = keys[:limit]
+        docs = keys >> POSITION_BITS
+        positions = keys & ((1 << POSITION_BITS) - 1)
+        results = []
+        for shard in self.shards:
+            in_shard = (docs >= shard.doc_base) & (docs < shard.doc_base + len(shard.docs))
+            local = docs[in_shard] - shard.doc_base
+            # The segment containing each shard-wide token position; with ties from
+            # empty segments the last one starting at or before the token holds it
+            segments = np.searchsorted(shard.segment_tokens, shard.token_base[local] + positions[in_shard],
+                                       side='right') - 1
+            corpus_segments = shard.corpus_segment[local] + segments - shard.segment_base[local]
+            for doc, segment in zip(local, corpus_segments):
+                results.append((shard.docs[doc]['video_id'], float(self.corpus.starts[segment]),
+                                self.corpus.segment_text(int(segment))))
+        return results
+
+    def close(self):
+        self.corpus.close()
+        self.shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Function to summarize album scores of a set of videos
+def score_summary(video_ids, scores):
+    values = np.array([scores[video_id] for video_id in video_ids if video_id in scores])
+    if not len(values):
+        return {'reviews': 0, 'mean': float('nan'), 'std': float('nan')}
+    return {'reviews': len(values), 'mean': float(values.mean()), 'std': float(values.std())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the transcript index and query it.")
+    parser.add_argument('queries', nargs='*', help="terms or quoted phrases to look up")
+    parser.add_argument('--near', nargs=2, metavar=('A', 'B'), help="occurrences of A within --window tokens of B")
+    parser.add_argument('--window', type=int, default=10)
+    parser.add_argument('--show', type=int, default=0, help="print this many occurrences per query with timestamps")
+    parser.add_argument('--index-dir', default=index_dir)
+    args = parser.parse_args()
+    # Only a build is a pipeline run; queries print their own timings
+    build_only = not args.queries and not args.near
+    if build_only:
+        start_run('09')
+
+    start_time = time.perf_counter()
+    with TranscriptCorpus(corpus_dir) as corpus:
+        added = update_index(corpus, args.index_dir)
+    if build_only:
+        count('items.processed', added)
+    if added:
+        print(f"Indexed {added} new transcripts in {time.perf_counter() - start_time:.2f}s.")
+
+    queries = [(query, None) for query in args.queries]
+    if args.near:
+        queries.append((f"{args.near[0]} ~{args.window}~ {args.near[1]}", args.near))
+    if not queries:
+        return
+
+    # Album scores as extracted by 02
+    scores = load_scores()
+    overall = score_summary(scores, scores)
+    print(f"{'query':<30} {'hits':>7} {'reviews':>8} {'mean':>6} {'vs all':>7} {'ms':>7}")
+    with InvertedIndex(args.index_dir, corpus_dir) as index:
+        for query, near in queries:
+            start_time = time.perf_counter()
+            keys = index.near(near[0], near[1], args.window) if near else index.phrase(query)
+            summary = score_summary(index.videos(keys), scores)
+            elapsed = (time.perf_counter() - start_time) * 1000
+            print(f"{query:<30} {len(keys):>7} {summary['reviews']:>8} {summary['mean']:>6.2f} "
+                  f"{summary['mean'] - overall['mean']:>+7.2f} {elapsed:>7.1f}")
+            for video_id, start, text in index.hits(keys, args.show):
+                print(f"    https://youtu.be/{video_id}?t={int(start)}  {text}")
+
+
+if __name__ == '__main__':
+    main()
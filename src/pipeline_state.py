@@ -0,0 +1,279 @@
+"""Per-video pipeline state shared by all stages.
+
+A small SQLite database (WAL mode) keyed by video ID records how far each
+video has got through the pipeline:
+
+    fetch_status       'fetched'                  01-data_acquisition
+    process_status     'processed'                02-data_processing
+    transcript_status  'fetched' | 'unavailable'  03-data_get_transcripts
+    spotify_status     'matched' | 'not_found'    04-data_get_spotify_features
+
+Stages look videos up by primary key, upsert their results in batches, and
+ask for the work left to do with one indexed query (`pending`). This
+replaces data/checksums.txt, which 01 and 02 used to share and clobber;
+`migrate_checksums` imports it once.
+"""
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from video_records import iter_videos
+
+LEDGER_FILE = 'data/pipeline_state.sqlite'
+CHECKSUM_FILE = 'data/checksums.txt'
+
+STAGES = ('fetch', 'process', 'transcript', 'spotify')
+
+# SQLite limits the number of parameters per statement
+QUERY_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT,
+    fetch_status TEXT,
+    process_status TEXT,
+    transcript_status TEXT,
+    spotify_status TEXT,
+    updated_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS videos_transcript_pending ON videos (video_id)
+    WHERE process_status = 'processed' AND transcript_status IS NULL;
+CREATE INDEX IF NOT EXISTS videos_spotify_pending ON videos (video_id)
+    WHERE process_status = 'processed' AND spotify_status IS NULL;
+CREATE TABLE IF NOT EXISTS legacy_checksums (
+    checksum TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+def open_ledger(path=LEDGER_FILE):
+    """Open (and create if needed) the ledger. The connection may be shared across threads."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Stages running side by side take turns writing; wait for the lock rather than failing
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+def _column(stage):
+    if stage not in STAGES:
+        raise ValueError(f"Unknown pipeline stage {stage!r}, expected one of {STAGES}")
+    return f"{stage}_status"
+
+def _now():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def status(conn, stage, video_id):
+    row = conn.execute(f"SELECT {_column(stage)} FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+    return row[0] if row else None
+
+def seen(conn, stage, video_ids):
+    """The subset of `video_ids` that already have a status for `stage`"""
+    column = _column(stage)
+    found = set()
+    for batch in _chunks(video_ids, QUERY_BATCH_SIZE):
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f"SELECT video_id FROM videos WHERE video_id IN ({placeholders}) "
+                            f"AND {column} IS NOT NULL", batch)
+        found.update(row[0] for row in rows)
+    return found
+
+def video_ids_with_status(conn, stage, status=None):
+    column = _column(stage)
+    if status is None:
+        rows = conn.execute(f"SELECT video_id FROM videos WHERE {column} IS NOT NULL")
+    else:
+        rows = conn.execute(f"SELECT video_id FROM videos WHERE {column} = ?", (status,))
+    return {row[0] for row in rows}
+
+def is_known_video(conn, video_id):
+    """Whether 01 has already fetched the video, either recorded here or in the old checksum file"""
+    if status(conn, 'fetch', video_id) is not None:
+        return True
+    checksum = hashlib.sha256(video_id.encode()).hexdigest()
+    return conn.execute("SELECT 1 FROM legacy_checksums WHERE checksum = ?", (checksum,)).fetchone() is not None
+
+def pending(conn, stage):
+    """(video_id, title) pairs of processed album reviews with no status yet for `stage`"""
+    column = _column(stage)
+    # Spotify is searched by title, so untitled videos (e.g. migrated ones) can never be done
+    untitled = " AND title IS NOT NULL AND title != ''" if stage == 'spotify' else ''
+    rows = conn.execute(f"SELECT video_id, title FROM videos "
+                        f"WHERE process_status = 'processed' AND {column} IS NULL{untitled} ORDER BY video_id")
+    return rows.fetchall()
+
+
+def mark(conn, stage, video_ids, status):
+    """Upsert `status` for `stage` on every video in one transaction"""
+    column = _column(stage)
+    now = _now()
+    with conn:
+        conn.executemany(
+            f"INSERT INTO videos (video_id, {column}, updated_at) VALUES (?, ?, ?) "
+            f"ON CONFLICT(video_id) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at",
+            ((video_id, status, now) for video_id in video_ids))
+
+def set_titles(conn, titles):
+    """Record video titles, from a dict of video ID to title"""
+    now = _now()
+    with conn:
+        conn.executemany(
+            "INSERT INTO videos (video_id, title, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at",
+            ((video_id, title, now) for video_id, title in titles.items()))
+
+
+def get_counter(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return int(row[0]) if row else 0
+
+def add_to_counter(conn, key, amount):
+    """Atomically add `amount` to an integer kept in the meta table, returning the new value"""
+    with conn:
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value",
+                     (key, amount))
+    return get_counter(conn, key)
+
+
+class BatchedMarker:
+    """Buffers status updates for one stage and writes them in batches.
+
+    Updates are flushed once `flush_every` have accumulated or
+    `flush_interval` seconds have passed. Safe to use from several threads;
+    call `flush` when the run finishes.
+    """
+
+    def __init__(self, conn, stage, flush_every=50, flush_interval=30.0):
+        self.conn = conn
+        self.stage = stage
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, video_id, status):
+        with self._lock:
+            self._pending[video_id] = status
+            if (len(self._pending) >= self.flush_every
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._flush()
+
+    def _flush(self):
+        by_status = {}
+        for video_id, status in self._pending.items():
+            by_status.setdefault(status, []).append(video_id)
+        for status, video_ids in by_status.items():
+            mark(self.conn, self.stage, video_ids, status)
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+
+# Function to stream videos from every dump in a directory
+def _iter_dump_videos(directory):
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(('.json', '.ndjson')):
+            yield from iter_videos(os.path.join(directory, name))
+
+def migrate_checksums(conn, checksum_file=CHECKSUM_FILE, data_dir='data'):
+    """Import the old checksum file and existing stage outputs into the ledger, once.
+
+    Videos in the processed dumps, or with a transcript or Spotify status,
+    are marked processed, and those plus the videos in the raw dumps are
+    marked fetched. Checksums are SHA-256 hashes of video IDs; those that
+    match none of these IDs are kept in legacy_checksums so 01 still treats
+    the videos as seen. Existing transcript files, the transcript negative
+    cache and Spotify feature files are imported as stage statuses.
+    """
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_checksums'").fetchone():
+        return False
+
+    try:
+        with open(checksum_file, 'r') as f:
+            checksums = {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        checksums = set()
+
+    def checksum_of(video_id):
+        return hashlib.sha256(video_id.encode()).hexdigest()
+
+    titles = {}
+    for video in _iter_dump_videos(os.path.join(data_dir, 'processed')):
+        titles[video['id']] = video['snippet']['title']
+    fetched = set(titles)
+    for video in _iter_dump_videos(os.path.join(data_dir, 'raw')):
+        fetched.add(video['id'])
+
+    transcripts_dir = os.path.join(data_dir, 'transcripts')
+    suffix = '_transcript.json'
+    transcripts = [name[:-len(suffix)] for name in os.listdir(transcripts_dir)
+                   if name.endswith(suffix)] if os.path.isdir(transcripts_dir) else []
+    cache_file = os.path.join(data_dir, 'cache', 'transcript_cache.json')
+    unavailable = []
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            unavailable = list(json.load(f))
+    spotify_dir = os.path.join(data_dir, 'spotify_features')
+    matched = [name[:-len('.json')] for name in os.listdir(spotify_dir)
+               if name.endswith('.json')] if os.path.isdir(spotify_dir) else []
+
+    # Later stages only ever saw processed videos
+    processed = set(titles).union(transcripts, unavailable, matched)
+    fetched |= processed
+
+    matched_checksums = {checksum_of(video_id) for video_id in fetched}
+    legacy = checksums - matched_checksums
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO legacy_checksums (checksum) VALUES (?)",
+                         ((checksum,) for checksum in legacy))
+    set_titles(conn, titles)
+    mark(conn, 'fetch', fetched, 'fetched')
+    mark(conn, 'process', processed, 'processed')
+    mark(conn, 'transcript', unavailable, 'unavailable')
+    mark(conn, 'transcript', transcripts, 'fetched')
+    mark(conn, 'spotify', matched, 'matched')
+    with conn:
+        conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_checksums', ?)", (_now(),))
+    print(f"Migrated {len(checksums)} checksums: {len(checksums) - len(legacy)} matched to video IDs, "
+          f"{len(legacy)} kept as legacy checksums.")
+    return True
+
+
+def main():
+    conn = open_ledger()
+    migrate_checksums(conn)
+    for stage in STAGES:
+        column = _column(stage)
+        rows = conn.execute(f"SELECT {column}, COUNT(*) FROM videos GROUP BY {column} ORDER BY {column}")
+        counts = ', '.join(f"{value or 'none'}: {count}" for value, count in rows)
+        print(f"{stage:>10}  {counts}")
+    for stage in ('transcript', 'spotify'):
+        print(f"{stage:>10}  {len(pending(conn, stage))} pending")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
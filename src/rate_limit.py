@@ -0,0 +1,54 @@
+import random
+import threading
+import time
+from instrumentation import count
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls out to at most `rate` per second.
+
+    A `burst` greater than one lets that many calls through back to back after
+    an idle period before the steady rate applies again.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Unused capacity from an idle period is capped at `burst` calls
+            earliest = now - (self.burst - 1) * self.interval
+            slot = max(self._next_slot, earliest)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            count('rate_limit.wait_seconds', delay)
+            time.sleep(delay)
+
+
+# Function to compute a full-jitter exponential backoff delay for a retry attempt
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Function to call `func` and retry it with jittered backoff on transient errors
+def retry_with_backoff(func, transient_errors, max_retries=4, base=1.0, cap=60.0, on_retry=None):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except transient_errors as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            count('retries')
+            if on_retry is not None:
+                on_retry(e, attempt, delay)
+            time.sleep(delay)
+            attempt += 1
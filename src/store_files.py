@@ -0,0 +1,41 @@
+"""File helpers shared by the on-disk stores (corpus, features, embeddings, index, exports).
+
+Each store keeps its data in append-only or write-once files and commits by
+replacing a small JSON manifest. `save_json` writes to a temporary file,
+syncs it and renames it over the old one, so a reader sees either the old or
+the new manifest and a crash never leaves a partial one. `map_array` maps
+the committed part of a flat binary array read-only.
+"""
+import json
+import os
+import numpy as np
+
+
+def load_json(path, default=None):
+    """The JSON document at `path`, or `default` when there is none yet"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def save_json(data, path):
+    """Atomically replace `path` with `data` as JSON, synced to disk first"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def map_array(path, dtype, shape=None):
+    """Read-only memory map of an array file, limited to `shape` (the whole file when None).
+
+    Empty arrays are returned without mapping, as numpy cannot map zero bytes.
+    """
+    if shape is None:
+        if not os.path.getsize(path):
+            return np.empty(0, dtype=dtype)
+    elif not np.prod(shape, dtype=np.int64):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
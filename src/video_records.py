@@ -0,0 +1,112 @@
+import json
+import os
+import re
+
+# Decoder reused for incremental parsing of JSON arrays
+_decoder = json.JSONDecoder()
+
+# First "<n>/10" in a review's album_score list
+score_value_pattern = re.compile(r"(\d+(?:\.\d+)?)/10")
+
+
+# Function to yield the elements of a top-level JSON array without loading the whole document
+def iter_json_array(file, chunk_size=1 << 16):
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    skip_whitespace()
+    if buffer[pos:pos + 1] == ']':
+        return
+    while True:
+        # Decode the next element, reading more input until it is complete
+        while True:
+            try:
+                item, end = _decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+        # A number at the end of the buffer may be cut off; make sure a delimiter follows
+        if not eof and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+            fill()
+            continue
+        pos = end
+        yield item
+        skip_whitespace()
+        delimiter = buffer[pos:pos + 1]
+        pos += 1
+        if delimiter == ']':
+            return
+        if delimiter != ',':
+            raise ValueError(f"Unexpected {delimiter!r} in JSON array")
+        skip_whitespace()
+
+
+# Function to stream videos from a dump, either a JSON array or NDJSON with one video per line
+def iter_videos(file_path):
+    with open(file_path, 'r') as file:
+        if file_path.endswith('.ndjson'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(file)
+
+
+def load_videos(file_path):
+    return list(iter_videos(file_path))
+
+
+# Function to write records as compact NDJSON, returning how many were written
+def write_ndjson(records, file):
+    count = 0
+    for record in records:
+        file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        count += 1
+    return count
+
+
+# Function to turn the scores found in a description into one number, or None
+def parse_score(album_scores):
+    for score in album_scores or []:
+        match = score_value_pattern.search(score)
+        if match:
+            return float(match.group(1))
+    return None
+
+# Function to read the album score of every processed review
+def load_scores(processed_dir='data/processed/'):
+    scores = {}
+    if not os.path.isdir(processed_dir):
+        return scores
+    for name in sorted(os.listdir(processed_dir)):
+        if not name.endswith(('.json', '.ndjson')):
+            continue
+        for video in iter_videos(os.path.join(processed_dir, name)):
+            score = parse_score(video.get('album_score'))
+            if score is not None and 0 <= score <= 10:
+                scores[video['id']] = score
+    return scores
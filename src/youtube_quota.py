@@ -0,0 +1,148 @@
+"""Quota-aware scheduling of YouTube Data API calls.
+
+Every call costs quota units against a daily budget (10,000 units by
+default) that resets at midnight Pacific time. `QuotaScheduler` executes
+requests on behalf of a stage, recording the units spent per call type in
+the pipeline ledger so the budget is shared by every run on the same day.
+
+Throttling (403 rateLimitExceeded, 429, 5xx) is retried with jittered
+exponential backoff. Quota exhaustion is not retried: the scheduler raises
+`QuotaExhausted`, before the call when the budget cannot cover it or after
+the API answers quotaExceeded, so the caller can checkpoint and stop.
+"""
+import datetime
+import json
+from collections import Counter
+from zoneinfo import ZoneInfo
+from googleapiclient.errors import HttpError
+from rate_limit import retry_with_backoff
+from pipeline_state import get_counter, add_to_counter
+from instrumentation import span, count, event
+
+DAILY_QUOTA = 10000
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+# Units charged per call; list calls cost 1 whatever parts are requested
+QUOTA_COSTS = {
+    'playlistItems.list': 1,
+    'videos.list': 1,
+    'channels.list': 1,
+    'search.list': 100,
+}
+
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+class Throttled(Exception):
+    """A throttled or failed call that is worth retrying"""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+# Function to pull the reason code out of an API error, e.g. 'quotaExceeded'
+def error_reason(error):
+    details = error.error_details
+    if isinstance(details, list):
+        for detail in details:
+            if isinstance(detail, dict) and detail.get('reason'):
+                return detail['reason']
+    return None
+
+def quota_day(now=None):
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return now.astimezone(QUOTA_TIMEZONE).date().isoformat()
+
+
+class QuotaScheduler:
+    """Executes YouTube API requests within a daily quota budget.
+
+    Keeps per-call-type counts of calls, units, retries and response bytes
+    (the size of the decoded JSON) for the run; see `report`. Requests
+    answered from the HTTP cache are counted separately and cost nothing.
+    """
+
+    def __init__(self, ledger, daily_budget=DAILY_QUOTA, max_retries=5, base=1.0, cap=64.0):
+        self.ledger = ledger
+        self.daily_budget = daily_budget
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.stats = {}
+
+    def _key(self):
+        return f"youtube_quota:{quota_day()}"
+
+    def used(self):
+        return get_counter(self.ledger, self._key())
+
+    def remaining(self):
+        return max(0, self.daily_budget - self.used())
+
+    def _stats(self, call_type):
+        return self.stats.setdefault(call_type, Counter())
+
+    def execute(self, call_type, request):
+        cost = QUOTA_COSTS.get(call_type, 1)
+        stats = self._stats(call_type)
+
+        def charge():
+            add_to_counter(self.ledger, self._key(), cost)
+            stats['calls'] += 1
+            stats['units'] += cost
+
+        def attempt():
+            if self.used() + cost > self.daily_budget:
+                raise QuotaExhausted(f"{call_type} needs {cost} units, {self.remaining()} left of "
+                                     f"today's {self.daily_budget}")
+            try:
+                with span(f"api.{call_type}"):
+                    response = request.execute()
+            except HttpError as e:
+                # Rejected calls are charged too
+                charge()
+                reason = error_reason(e)
+                if reason in QUOTA_REASONS:
+                    # Our count can lag behind the API's (other clients, other keys); trust the API
+                    add_to_counter(self.ledger, self._key(), max(0, self.daily_budget - self.used()))
+                    raise QuotaExhausted(f"{call_type} answered {reason}") from e
+                if e.resp.status == 429 or reason in RATE_LIMIT_REASONS or e.resp.status >= 500:
+                    raise Throttled(e) from e
+                raise
+            # Responses replayed by http_cache.CachedHttp never reached the API
+            if getattr(getattr(request, 'http', None), 'from_cache', False):
+                stats['cached'] += 1
+            else:
+                charge()
+                size = len(json.dumps(response, separators=(',', ':')))
+                stats['bytes'] += size
+                count('api.calls')
+                count('bytes.downloaded', size)
+            return response
+
+        def on_retry(error, attempt_number, delay):
+            stats['retries'] += 1
+            event('throttled', call=call_type, status=error.error.resp.status, reason=error_reason(error.error),
+                  delay=round(delay, 2))
+
+        try:
+            return retry_with_backoff(attempt, Throttled, self.max_retries, self.base, self.cap, on_retry)
+        except Throttled as e:
+            raise e.error
+
+    def report(self):
+        total = Counter()
+        lines = []
+        for call_type, stats in sorted(self.stats.items()):
+            total.update(stats)
+            lines.append(f"  {call_type:<20} {stats['calls']:>6} calls {stats['units']:>6} units "
+                         f"{stats['cached']:>6} cached {stats['retries']:>4} retries {stats['bytes'] / 1e6:>8.2f} MB")
+        lines.insert(0, f"YouTube API: {total['calls']} calls, {total['units']} units, {total['cached']} from cache, "
+                        f"{total['bytes'] / 1e6:.2f} MB; {self.remaining()} of {self.daily_budget} units left today.")
+        return '\n'.join(lines)